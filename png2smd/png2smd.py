@@ -3,29 +3,117 @@
 #
 # Converts each pixel in a PNG image to an SMD model (cube per pixel)
 # Optimizes for same coloured pixels and adjacent pixels (faces)
-# Using: Python-2.5+ (python.org), pypng (code.google.com/p/pypng)
+# Using: Python-2.6+ (python.org), pypng (code.google.com/p/pypng)
 #
-# Usage: png2smd.py <-f> <-x> <-y> <-z> [-c]
+# Usage: png2smd.py <-f|-d> <-x> <-y> <-z> [-c] [-o] [--jobs] [--no-cache] [--cache-dir]
+#                   [--cache-size] [--tile] [--grid] [--frames] [--block-size] [--padding]
+#                   [--stats] [--profile] [--engine] [--mesher] [--format] [--max-colours]
+#                   [--alpha-threshold] [--lods] [--triangle-budget] [--atlas] [--atlas-size]
+#                   [--max-hulls] [--hull-tolerance] [--merge-faces] [--dry-run]
+#                   [--max-triangles] [--max-bytes] [--max-texture] [--verify-incremental]
 #
-#    -f specify input file (ie. -f file.png) - mandatory
+#    -f specify input file (ie. -f file.png) - mandatory (unless -d is used)
+#    -d specify input directory or glob for batch mode (ie. -d 'art/*.png')
 #    -x specify width-per-pixel (ie. -x 32) - mandatory
 #    -y specify depth-per-pixel (ie. -y 16) - mandatory
 #    -z specify height-per-pixel (ie. -z 32) - mandatory
 #    -c specify collision mesh scale (ie. -c 1.0) - optional
+#    --max-hulls specify most boxes in the collision mesh, fitted to the opaque pixels (ie. --max-hulls 8) - optional
+#    --hull-tolerance specify fraction of a collision box that may be transparent (ie. --hull-tolerance 0.1) - optional
+#    -o specify output directory (ie. -o models) - optional
+#    --jobs specify number of worker processes for batch mode, tiles, frames and writing
+#      large models (ie. --jobs 4) - optional, large models are only written in parallel if given
+#      (their cubes being both expanded to triangles and formatted by the workers)
+#    --no-cache disables the conversion cache - optional
+#    --cache-dir specify conversion cache directory (ie. --cache-dir ~/.png2smd_cache) - optional
+#    --cache-size specify conversion cache size in MB (ie. --cache-size 512) - optional
+#    --tile specify tile size to split the model into (ie. --tile 64x64) - optional
+#    --grid specify sprite sheet frames as columns and rows (ie. --grid 8x2) - optional
+#    --frames specify sprite sheet frames as a JSON list of [x, y, w, h] (ie. --frames frames.json) - optional
+#    --block-size specify size of each colour's block in the texture (ie. --block-size 16) - optional
+#    --padding specify padding around each colour's block in the texture (ie. --padding 2) - optional
+#    --atlas specify shared atlas file to use (and create or extend) for the texture (ie. --atlas props.json) - optional
+#    --atlas-size specify texture size of a new shared atlas (ie. --atlas-size 512) - optional
+#    --stats specify file to write stage timings and geometry counts to (ie. --stats stats.json) - optional
+#      (the open stage reads the PNG header, and the decode stage decodes it into the engine's image)
+#    --profile specify directory to write a cProfile dump per file to (ie. --profile prof) - optional
+#    --engine specify image engine, object, numpy, stream, incremental or sparse (ie. --engine numpy) - optional
+#    --verify-incremental checks incremental models are byte-identical to a full conversion - optional
+#    --mesher specify cube merging, rows or greedy (ie. --mesher greedy) - optional
+#      (the stream and incremental engines only support rows)
+#    --format specify model format, smd or bin (ie. --format bin) - optional
+#    --max-colours specify number of colours to quantize the image to (ie. --max-colours 32) - optional
+#    --alpha-threshold specify alpha below which pixels are made transparent (ie. --alpha-threshold 128) - optional
+#    --lods specify number of lower levels of detail to write (ie. --lods 3) - optional
+#    --triangle-budget specify most triangles the model may have (ie. --triangle-budget 5000) - optional
+#    --merge-faces joins coplanar faces of the same colour into larger faces - optional
+#    --dry-run reports the model's size without writing anything - optional
+#    --max-triangles specify most triangles a dry run model may have (ie. --max-triangles 5000) - optional
+#    --max-bytes specify largest a dry run model file may be (ie. --max-bytes 1000000) - optional
+#    --max-texture specify largest a dry run texture may be (ie. --max-texture 256) - optional
 #
 # if -c is not specified, no collision mesh will be generated
 # mesh scale only affects the x and y dimensions (of the image)
 # if mesh scale is 0, mesh will be generated based on min/max bounds
+# with --max-hulls, the collision mesh is boxes covering the opaque pixels (mesh scale is ignored),
+# boxes are merged (adding the fewest transparent pixels) until there are at most max hulls,
+# and while the merged box is within the hull tolerance
+# the greedy mesher merges each colour region into rectangles (fewer triangles)
+# merging faces draws each colour region's front and back as rectangles and joins walls along straight edges
+# batch mode prints a summary per file and fails if any file failed to convert
+# quantizing (which requires numpy) merges similar colours by median cut, reporting the error
+# the alpha threshold makes every other pixel fully opaque
+# levels of detail (mdl_<name>_lod<n>.smd) halve the image each level, keeping its colours and texture
+# with a triangle budget, the model is the most detailed level within the budget (lods follow on from it)
+# the bin format writes binary indexed meshes (.psmb, see psmdlib) in place of .smd files
+# the stream engine reads the image row by row to convert large images in little memory
+# (its levels of detail are downsampled as the image is read again, two rows at a time),
+# but --merge-faces and --max-hulls lay out a grid the size of the whole image, so they
+# don't keep to its memory bound
+# (quantizing for it reads the image once more to count its colours)
+# the incremental engine keeps a sidecar (mdl_<name>.inc) to only re-mesh edited rows next time
+# the sparse engine only holds opaque runs, so mostly transparent images convert quickly
+# indexed (palette) images are read as palette indices, which the object, numpy and sparse
+# engines merge on directly (other engines and options read them expanded to RGBA)
+# tiles are written as mdl_<name>_<tx>_<ty>.smd (or .psmb) with a manifest (mdl_<name>_tiles.json)
+# sprite sheet frames are written as mdl_<name>_f<n>.smd with a manifest (mdl_<name>_frames.json)
+# a shared atlas (texture tex_<atlas name>.png) gathers every input's colours before converting,
+# new colours are added without moving existing ones (so its size is fixed when created)
+# a dry run stops after meshing and laying out the texture, measuring the model without formatting it,
+# and fails if a model is over the --max-triangles, --max-bytes or --max-texture budget
+# outputs are cached by image content and parameters (PNG2SMD_CACHE sets the default cache directory)
+# convert_buffers() converts in memory for use as a library (see png2smd_server.py)
 #
 
 from __future__ import with_statement
 import os
+import re
 import sys
 import png
+import glob
+import shutil
+import json
+import time
 import getopt
-from psmdlib import Model, Objects, UV, Vec3 as Vector
+import cProfile
+import hashlib
+import heapq
+import bisect
+import itertools
+import contextlib
+from StringIO import StringIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from array import array
+try: import numpy
+except ImportError: numpy = None
+try: import resource
+except ImportError: resource = None
+from psmdlib import Model, Meta, Objects, Faces, UV, uv_corners, Vec3 as Vector
+from psmdlib import SmdMeasure, BinaryMeshStream
 
 DEBUG = 0
+VERSION = '1.1'
 
 # RGBA structure (r, g, b, a)
 class RGBA(object):
@@ -38,15 +126,22 @@ class RGBA(object):
         self.a = a
 
 # png.Reader wrapper for reading an 8-bpp RGBA image
+# Indexed images keep their palette (as RGBA tuples) and rows of palette indices,
+# image then being those rows expanded to RGBA as they are read
 class RgbaPngImage8(object):
 
     # Constructor: Load data from image
-    def __init__(self, file_path):
+    # (data may be given to read PNG file data from memory rather than file_path)
+    def __init__(self, file_path, data = None):
         self.file_path = file_path
         self.file_name = os.path.basename(file_path)
+        self.file_data = data
+        self.palette, self.indices = None, None
 
-        reader = png.Reader(filename = self.file_path)
-        self.data = reader.asRGBA()
+        reader = self.get_reader()
+        reader.preamble()
+        if reader.colormap: self.data = self.read_indexed(reader)
+        else: self.data = reader.asRGBA()
         try: data_siz = len(self.data)
         except TypeError: data_siz = 0
         if data_siz == 4: self.validate_file()
@@ -69,6 +164,434 @@ class RgbaPngImage8(object):
             raise Exception('Image must have an alpha channel')
         self.image = self.data[2]
 
+    # Read the palette and index rows of an indexed image, returning its data as
+    # png.Reader.asRGBA would (palette colours being 8-bpp RGBA whatever the index depth)
+    def read_indexed(self, reader):
+        width, height, rows, info = reader.read()
+        self.palette = [tuple(rgba) for rgba in reader.palette(alpha = 'force')]
+        self.indices = rows
+        info.update(bitdepth = 8, alpha = True, planes = 4)
+        return width, height, self.expand_rows(rows), info
+
+    # Yield the RGBA rows of rows of palette indices
+    def expand_rows(self, rows):
+        colours = [array('B', rgba).tostring() for rgba in self.palette]
+        for row in rows:
+            yield array('B', ''.join(map(colours.__getitem__, row)))
+
+    # Return a fresh iterator over the image rows (decoding the file again)
+    def read_rows(self):
+        return self.get_reader().asRGBA()[2]
+
+    # Return a png.Reader for the image
+    def get_reader(self):
+        if self.file_data is not None: return png.Reader(bytes = self.file_data)
+        return png.Reader(filename = self.file_path)
+
+# Return the name of the image file_name's model as passed to PixelCubeImage.write
+def model_name(file_name):
+    return file_name.replace('.png', '.smd')
+
+# Return the output file name of a model written as file_name (see model_name) in
+# output_format, with suffix (ie. '_phys') added before the extension
+def model_file_name(file_name, suffix = '', output_format = 'smd'):
+    if not suffix and output_format == 'smd': return 'mdl_' + file_name
+    return 'mdl_' + file_name.replace('.smd', '') + suffix + Extensions[output_format]
+
+# Return the path of an output file, or a new in-memory buffer for it when outputs
+# (a dictionary of buffers by file name) is given
+def output_file(name, output_dir = '', outputs = None):
+    if outputs is None: return os.path.join(output_dir, name)
+    outputs[name] = StringIO()
+    return outputs[name]
+
+# Split a grid of colour keys (None for transparent) into rectangles of the
+# same colour, returned as (x, y, width, height) with y being the top row
+def greedy_rectangles(keys, width, height):
+    done = [[False] * width for i in xrange(height)]
+    rects = []
+    for y in xrange(height):
+        row, row_done = keys[y], done[y]
+        x = 0
+        while x < width:
+            key = row[x]
+            if key is None or row_done[x]:
+                x += 1
+                continue
+            w = 1
+            while x + w < width and row[x+w] == key and not row_done[x+w]:
+                w += 1
+            h = 1
+            while y + h < height:
+                below, below_done = keys[y+h], done[y+h]
+                for ix in xrange(x, x + w):
+                    if below[ix] != key or below_done[ix]: break
+                else:
+                    h += 1
+                    continue
+                break
+            for iy in xrange(y, y + h):
+                done[iy][x:x+w] = [True] * w
+            rects.append((x, y, w, h))
+            x += w
+    return rects
+
+# Every face ObjectMaker_Cube draws (a box's faces are a mask of those it leaves out)
+AllFaces = Faces.Top | Faces.Bottom | Faces.Front | Faces.Right | Faces.Back | Faces.Left
+
+# Return boxes (see PixelCubeImage.get_boxes, a list) redrawn with coplanar faces of the
+# same colour merged: the front and back faces as each colour region's rectangles (see
+# greedy_rectangles) and the uncovered side faces joined along each straight edge.
+# Each returned box only draws the faces missing from its mask
+def merge_box_faces(boxes, width, height):
+    keys = [[None] * width for i in xrange(height)]
+    walls = {}
+    for x, y, w, h, rgb, faces in boxes:
+        top = y - h + 1
+        for iy in xrange(top, y + 1):
+            keys[iy][x:x+w] = [rgb] * w
+        if not faces & Faces.Top: walls.setdefault((Faces.Top, top, rgb), []).append((x, x + w))
+        if not faces & Faces.Bottom: walls.setdefault((Faces.Bottom, y, rgb), []).append((x, x + w))
+        if not faces & Faces.Left: walls.setdefault((Faces.Left, x, rgb), []).append((top, y + 1))
+        if not faces & Faces.Right:
+            walls.setdefault((Faces.Right, x + w - 1, rgb), []).append((top, y + 1))
+    # the boxes' own rectangles are kept where the colour regions split into more
+    rects = greedy_rectangles(keys, width, height)
+    if len(rects) > len(boxes): rects = [(x, y - h + 1, w, h) for x, y, w, h, rgb, faces in boxes]
+    merged = [(x, y + h - 1, w, h, keys[y][x], AllFaces & ~(Faces.Front | Faces.Back))
+        for x, y, w, h in rects]
+    for (face, at, rgb), spans in sorted(walls.iteritems()):
+        for start, end in join_spans(spans):
+            if face in (Faces.Top, Faces.Bottom):
+                merged.append((start, at, end - start, 1, rgb, AllFaces & ~face))
+            else: merged.append((at, end - 1, 1, end - start, rgb, AllFaces & ~face))
+    return merged
+
+# Most rectangles collision_boxes merges pairwise (coarser rectangles are used above it)
+HullRectangles = 256
+
+# Return at most max_hulls (x, y, x2, y2) boxes (x2 and y2 exclusive) covering the
+# opaque pixels of boxes (see PixelCubeImage.get_boxes). The opaque pixels are split
+# into rectangles, then the pair whose bounding box adds the fewest transparent pixels
+# is merged while there are more than max_hulls boxes, or while the merged box is at
+# most tolerance (a fraction of its area) transparent
+def collision_boxes(boxes, width, height, max_hulls, tolerance = 0.0):
+    keys = [[None] * width for i in xrange(height)]
+    for x, y, w, h, rgb, faces in boxes:
+        for iy in xrange(y - h + 1, y + 1):
+            keys[iy][x:x+w] = [True] * w
+    # summed area table of opaque pixels
+    sums = [[0] * (width + 1) for i in xrange(height + 1)]
+    for y in xrange(height):
+        row, above, below, total = keys[y], sums[y], sums[y+1], 0
+        for x in xrange(width):
+            if row[x]: total += 1
+            below[x+1] = above[x+1] + total
+    def opaque(x, y, x2, y2):
+        return sums[y2][x2] - sums[y][x2] - sums[y2][x] + sums[y][x]
+    def empty(box):
+        x, y, x2, y2 = box
+        return (x2 - x) * (y2 - y) - opaque(x, y, x2, y2)
+    # halve the resolution until there are few enough rectangles to merge
+    scale, grid, grid_width, grid_height = 1, keys, width, height
+    while True:
+        rects = greedy_rectangles(grid, grid_width, grid_height)
+        if len(rects) <= max(HullRectangles, max_hulls): break
+        scale, grid_width, grid_height = scale * 2, (grid_width + 1) // 2, (grid_height + 1) // 2
+        grid = [[True if [row for row in keys[y*scale:(y+1)*scale] if True in
+            row[x*scale:(x+1)*scale]] else None for x in xrange(grid_width)]
+            for y in xrange(grid_height)]
+    hulls = dict((n, (x * scale, y * scale, min((x + w) * scale, width),
+        min((y + h) * scale, height))) for n, (x, y, w, h) in enumerate(rects))
+    def pair(i, j):
+        a, b = hulls[i], hulls[j]
+        box = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+        return (empty(box) - empty(a) - empty(b), i, j, box)
+    ids = sorted(hulls)
+    heap = [pair(i, j) for n, i in enumerate(ids) for j in ids[n+1:]]
+    heapq.heapify(heap)
+    next_id = len(rects)
+    while heap:
+        added, i, j, box = heapq.heappop(heap)
+        if not (i in hulls and j in hulls): continue
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        if len(hulls) <= max_hulls and empty(box) > tolerance * area: break
+        del hulls[i], hulls[j]
+        # drop any boxes the merged box covers
+        for k in [k for k, b in hulls.iteritems() if box[0] <= b[0] and box[1] <= b[1] and
+                b[2] <= box[2] and b[3] <= box[3]]:
+            del hulls[k]
+        n, next_id = next_id, next_id + 1
+        hulls[n] = box
+        for k in hulls.keys():
+            if not k == n: heapq.heappush(heap, pair(k, n))
+    # shrink the boxes to the opaque pixels they cover (coarser rectangles overhang them)
+    tight = []
+    for x, y, x2, y2 in hulls.itervalues():
+        while not opaque(x, y, x + 1, y2): x += 1
+        while not opaque(x2 - 1, y, x2, y2): x2 -= 1
+        while not opaque(x, y, x2, y + 1): y += 1
+        while not opaque(x, y2 - 1, x2, y2): y2 -= 1
+        tight.append((x, y, x2, y2))
+    return sorted(tight, key = lambda box: (box[3], box[0]))
+
+# Rectangular view of decoded RGBA rows, usable in place of an RgbaPngImage8
+# Rows spanning the whole width are passed through, others are sliced (copied) one
+# at a time as the region is read: the engines index rows for integer pixel values,
+# which Python 2 buffers and memoryviews don't give, so a region can't be a view
+class RgbaImageRegion(object):
+
+    # Constructor
+    def __init__(self, rows, file_name, x, y, width, height):
+        self.rows = rows
+        self.file_name = file_name
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+        self.image = itertools.islice(rows, y, y + height)
+        if x > 0 or rows and len(rows[0]) > width * 4:
+            self.image = (row[x*4:(x+width)*4] for row in self.image)
+
+    # Return the opaque pixels surrounding the region, relative to the region
+    def get_border(self):
+        full_width, full_height = len(self.rows[0]) // 4, len(self.rows)
+        ring = [(ix, iy) for iy in (self.y - 1, self.y + self.height)
+            for ix in xrange(self.x - 1, self.x + self.width + 1)]
+        ring += [(ix, iy) for ix in (self.x - 1, self.x + self.width)
+            for iy in xrange(self.y, self.y + self.height)]
+        return [(ix - self.x, iy - self.y) for ix, iy in ring
+            if 0 <= ix < full_width and 0 <= iy < full_height and self.rows[iy][ix*4+3] > 0]
+
+# Split colours into at most max_colours boxes by median cut, returning the palette
+# (the weighted mean of each box) and the palette index of each colour, where
+# colours is a (n, 3) array of distinct colours and weights counts their pixels
+# The box with the largest squared error is split at the weighted median of its
+# widest channel, until there are max_colours boxes or no box can be split
+def median_cut(colours, weights, max_colours):
+    values, weights = colours.astype(numpy.float64), weights.astype(numpy.float64)
+    def measure(idx):
+        w = weights[idx]
+        mean = (values[idx] * w[:, numpy.newaxis]).sum(0) / w.sum()
+        variance = ((values[idx] - mean) ** 2 * w[:, numpy.newaxis]).sum(0)
+        return variance.sum() if len(idx) > 1 else 0.0, int(variance.argmax()), idx
+    boxes = [measure(numpy.arange(len(colours)))]
+    while len(boxes) < max_colours:
+        i = max(xrange(len(boxes)), key = lambda i: boxes[i][0])
+        error, axis, idx = boxes[i]
+        if error <= 0: break
+        idx = idx[numpy.argsort(values[idx, axis], kind = 'mergesort')]
+        total = numpy.cumsum(weights[idx])
+        split = int(numpy.searchsorted(total, total[-1] / 2.0)) + 1
+        split = min(max(split, 1), len(idx) - 1)
+        boxes[i:i+1] = [measure(idx[:split]), measure(idx[split:])]
+    palette = numpy.zeros((len(boxes), 3), dtype = numpy.uint8)
+    labels = numpy.zeros(len(colours), dtype = numpy.int32)
+    for n, (error, axis, idx) in enumerate(boxes):
+        w = weights[idx]
+        mean = (values[idx] * w[:, numpy.newaxis]).sum(0) / w.sum()
+        palette[n] = numpy.clip(numpy.round(mean), 0, 255)
+        labels[idx] = n
+    return palette, labels
+
+# Image with its colours reduced to at most max_colours (by median cut over its
+# opaque pixels), usable in place of an RgbaPngImage8
+# If alpha_threshold is given, pixels less opaque than it become transparent and
+# the rest fully opaque. Transparent pixels are all made (0, 0, 0, 0)
+class QuantizedImage(object):
+
+    # Constructor: Quantize the (decoded) rows of an RgbaPngImage8 image
+    def __init__(self, img, max_colours = None, alpha_threshold = None):
+        if numpy is None:
+            raise Exception('Colour quantization requires NumPy to be installed')
+        self.file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        rows = [numpy.asarray(row, dtype = numpy.uint8)[:self.width * 4] for row in img.image]
+        if len(rows) < self.height or [r for r in rows if len(r) < self.width * 4]:
+            raise Exception('Unexpected end-of-file')
+        rgba = numpy.vstack(rows).reshape(-1, 4)
+        if not alpha_threshold is None:
+            rgba[:, 3] = numpy.where(rgba[:, 3] < alpha_threshold, 0, 255)
+        opaque = rgba[:, 3] > 0
+        rgba[~opaque] = 0
+        rgb = rgba[opaque, :3].astype(numpy.int32)
+        packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        unique, inverse, counts = numpy.unique(packed, return_inverse = True, return_counts = True)
+        self.colours, self.error, self.max_error = len(unique), 0.0, 0
+        if max_colours and len(unique) > max_colours:
+            colours = numpy.column_stack(((unique >> 16) & 255, (unique >> 8) & 255, unique & 255))
+            palette, labels = median_cut(colours, counts, max_colours)
+            quantized = palette[labels[inverse]]
+            diff = quantized.astype(numpy.int32) - rgb
+            self.error = float(numpy.sqrt((diff ** 2).mean()))
+            self.max_error = int(numpy.abs(diff).max())
+            rgba[opaque, :3] = quantized
+            self.palette_size = len(palette)
+        else: self.palette_size = len(unique)
+        self.rows = [bytearray(row.tostring()) for row in rgba.reshape(self.height, self.width * 4)]
+        self.image = iter(self.rows)
+
+    # Return an iterator over the quantized rows
+    def read_rows(self):
+        return iter(self.rows)
+
+# QuantizedImage for the stream engine, which never holds the whole image: the rows
+# are read once to count the colours (as QuantizedImage quantizes them), then each
+# time the image is read (see read_rows) quantized row by row as they're decoded
+class StreamingQuantizedImage(object):
+    CountPixels = 1 << 20
+
+    # Constructor: Count the colours of an RgbaPngImage8 image's rows and pick the palette
+    def __init__(self, img, max_colours = None, alpha_threshold = None):
+        if numpy is None:
+            raise Exception('Colour quantization requires NumPy to be installed')
+        self.img = img
+        self.file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        self.alpha_threshold = alpha_threshold
+        unique, counts = numpy.zeros(0, numpy.int32), numpy.zeros(0, numpy.int64)
+        pending, pixels, rows = [], 0, 0
+        for rgba in self.threshold_rows(img.image):
+            rows += 1
+            pending.append(self.pack(rgba[rgba[:, 3] > 0]))
+            pixels += len(pending[-1])
+            if pixels < StreamingQuantizedImage.CountPixels and rows < self.height: continue
+            # fold the pending pixels' colours into the counts so far
+            unique, inverse = numpy.unique(numpy.concatenate([unique] + pending),
+                return_inverse = True)
+            weights = numpy.concatenate([counts] + [numpy.ones(len(packed), numpy.int64)
+                for packed in pending])
+            counts = numpy.bincount(inverse, weights, len(unique)).astype(numpy.int64)
+            pending, pixels = [], 0
+        if rows < self.height: raise Exception('Unexpected end-of-file')
+        colours = numpy.column_stack(((unique >> 16) & 255, (unique >> 8) & 255, unique & 255))
+        self.unique, self.quantized = unique, colours
+        self.colours, self.error, self.max_error = len(unique), 0.0, 0
+        if max_colours and len(unique) > max_colours:
+            palette, labels = median_cut(colours, counts, max_colours)
+            self.quantized = palette[labels]
+            diff = self.quantized.astype(numpy.int32) - colours
+            self.error = float(numpy.sqrt((diff ** 2 * counts[:, numpy.newaxis]).sum() /
+                (counts.sum() * 3.0)))
+            self.max_error = int(numpy.abs(diff).max())
+            self.palette_size = len(palette)
+        else: self.palette_size = len(unique)
+        self.image = self.read_rows()
+
+    # Return the 0xRRGGBB colours of an (n, 4) array of RGBA pixels
+    def pack(self, rgba):
+        rgb = rgba[:, :3].astype(numpy.int32)
+        return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+    # Yield RGBA rows as (width, 4) arrays, with alpha thresholded and transparent
+    # pixels made (0, 0, 0, 0) as in QuantizedImage
+    def threshold_rows(self, rows):
+        for row in rows:
+            rgba = numpy.array(row, dtype = numpy.uint8)[:self.width * 4]
+            if len(rgba) < self.width * 4: raise Exception('Unexpected end-of-file')
+            rgba = rgba.reshape(-1, 4)
+            if not self.alpha_threshold is None:
+                rgba[:, 3] = numpy.where(rgba[:, 3] < self.alpha_threshold, 0, 255)
+            rgba[rgba[:, 3] == 0] = 0
+            yield rgba
+
+    # Return an iterator quantizing the rows as the image is decoded again
+    def read_rows(self):
+        for rgba in self.threshold_rows(self.img.read_rows()):
+            opaque = rgba[:, 3] > 0
+            rgba[opaque, :3] = self.quantized[numpy.searchsorted(self.unique,
+                self.pack(rgba[opaque]))]
+            yield bytearray(rgba.tostring())
+
+# Yield RGBA rows halved (rounding up) for a level of detail, where each 2x2 block
+# becomes its most common opaque colour (the first of them in a tie), keeping the
+# image's colours. Blocks less than half opaque become transparent
+# rows (an iterable) are read two at a time, so they may be streamed
+def downsample_rows(rows, width, height):
+    width2, rows = (width + 1) // 2, iter(rows)
+    for y in xrange(0, height, 2):
+        pair = [bytearray(row) for row in itertools.islice(rows, min(2, height - y))]
+        if not len(pair) == min(2, height - y) or [row for row in pair if len(row) < width * 4]:
+            raise Exception('Unexpected end-of-file')
+        row2 = bytearray(width2 * 4)
+        for x in xrange(width2):
+            i, i2 = x * 8, min(x * 8 + 8, width * 4)
+            pixels = [str(row[j:j+4]) for row in pair for j in xrange(i, i2, 4)]
+            opaque = [p for p in pixels if not p[3] == '\0']
+            if len(opaque) * 2 < len(pixels): continue
+            row2[x*4:x*4+4] = max(opaque, key = lambda p: (opaque.count(p), -opaque.index(p)))
+        yield row2
+
+# Level of detail of an image, usable in place of an RgbaPngImage8 (ie. by the stream
+# engine), downsampled level times as its rows are read (see downsample_rows) so that
+# only two rows of each level are held at a time
+class DownsampledImage(object):
+
+    # Constructor: img being an image with read_rows (ie. an RgbaPngImage8)
+    def __init__(self, img, level):
+        self.img = img
+        self.file_name = img.file_name
+        self.sizes = [(img.width, img.height)]
+        for i in xrange(level):
+            width, height = self.sizes[-1]
+            self.sizes.append(((width + 1) // 2, (height + 1) // 2))
+        self.width, self.height = self.sizes[-1]
+        self.image = self.read_rows()
+
+    # Return an iterator downsampling the rows as the image is read again
+    def read_rows(self):
+        rows = self.img.read_rows()
+        for width, height in self.sizes[:-1]:
+            rows = downsample_rows(rows, width, height)
+        return rows
+
+# Yield the levels of detail of an image (with read_rows, ie. an RgbaPngImage8) as
+# (level, image, vdimensions) where each level halves the last, scaling up vdimensions
+# to keep the model's size (by the actual shrink of each side, as odd sizes are rounded
+# up). Each level is an RgbaImageRegion of the last level's downsampled rows, or if
+# streaming is set a DownsampledImage reading the image again (see the stream engine)
+def lod_images(img, vdimensions, streaming = False):
+    rows, width, height, level = img.read_rows(), img.width, img.height, 0
+    while True:
+        level += 1
+        if streaming: lod = DownsampledImage(img, level)
+        else:
+            rows = list(downsample_rows(rows, width, height))
+            lod = RgbaImageRegion(rows, img.file_name, 0, 0, (width + 1) // 2,
+                (height + 1) // 2)
+        width, height = lod.width, lod.height
+        yield level, lod, Vector(vdimensions.x * img.width / float(width), vdimensions.y,
+            vdimensions.z * img.height / float(height))
+
+# Return an image's colour palette (in first occurrence order) from RGBA rows
+def read_palette(rows, width):
+    palette = {}
+    for row in rows:
+        for i in xrange(0, width * 4, 4):
+            rgba = (row[i], row[i+1], row[i+2], row[i+3])
+            if not rgba in palette: palette[rgba] = RGBA(*rgba)
+    return palette
+
+# Return an indexed image's colour palette (see read_palette) from its palette indices
+def read_indexed_palette(img):
+    palette = {}
+    def add(idx):
+        rgba = img.palette[idx]
+        if not rgba in palette: palette[rgba] = RGBA(*rgba)
+    for row in scan_indices(img.indices, img.width, add): pass
+    return palette
+
+# Call add(index) for each palette index used by rows of palette indices, in first
+# occurrence order, yielding the rows (only rows with unseen indices are searched)
+def scan_indices(rows, width, add):
+    seen = set()
+    for row in rows:
+        if len(row) < width: raise Exception('Unexpected end-of-file')
+        if not seen.issuperset(row):
+            for idx in row:
+                if not idx in seen:
+                    seen.add(idx)
+                    add(idx)
+        yield row
+
 # Structure of pixel data with some hints for 3D (pixel to cube) translation
 class PixelCube(object):
     
@@ -77,11 +600,12 @@ class PixelCube(object):
         self.position = position
         self.colour = colour
         self.scale = Vector(1, 1, 1)
-        self.ex_faces = list()
+        self.ex_faces = 0
         self.visible = True
         
 # Used to represent an image in 3D cubes
 class PixelCubeImage(object):
+    Meshers = ('rows', 'greedy')
 
     # Constructor: Create needed cubes from an RgbaPngImage8 image
     def __init__(self, img):
@@ -89,7 +613,11 @@ class PixelCubeImage(object):
         self.width, self.height = img.width, img.height
         self.colour_palette = {}
         self.cubes = []
-        self.positions2d = []
+        self.positions2d = set()
+        self.occupancy = self.positions2d
+        if getattr(img, 'palette', None) is not None:
+            self.read_indexed(img)
+            return
         x, y, i = 0, 0, 0
         for row in img.image:
             i = 0
@@ -101,13 +629,26 @@ class PixelCubeImage(object):
                         row[i], row[i+1], row[i+2], row[i+3])
                     self.cubes.append(PixelCube(vpos, rgba))
                     if not rgba.a == 0:
-                        self.positions2d.append((vpos.x, vpos.y))
+                        self.positions2d.add((vpos.x, vpos.y))
                     x += 1
                     i += 4
             else: raise Exception('Unexpected end-of-file')
             x = 0
             y += 1
 
+    # Create cubes from the rows of palette indices of an indexed image, looking each
+    # pixel's colour up by its index rather than hashing its RGBA values
+    def read_indexed(self, img):
+        colours = [None] * len(img.palette)
+        def add(idx):
+            colours[idx] = self.get_rgba_from_palette(*img.palette[idx])
+        for y, row in enumerate(scan_indices(img.indices, self.width, add)):
+            for x in xrange(self.width):
+                rgba = colours[row[x]]
+                self.cubes.append(PixelCube(Vector(x, y, 0), rgba))
+                if not rgba.a == 0:
+                    self.positions2d.add((x, y))
+
     # Use colour palette as a cache to return colours
     def get_rgba_from_palette(self, r, g, b, a):
         if (r, g, b, a) in self.colour_palette:
@@ -125,7 +666,7 @@ class PixelCubeImage(object):
                 col, colp = cube.colour, cube_prev.colour
                 pos, posp = cube.position, cube_prev.position
                 if pos.y == posp.y and colp.a > 0:
-                    if (col.r, col.g, col.b) == (colp.r, colp.g, colp.b):
+                    if col is colp or (col.r, col.g, col.b) == (colp.r, colp.g, colp.b):
                         cube_prev.scale.x += 1
                         cube.visible = False
                         continue
@@ -144,144 +685,260 @@ class PixelCubeImage(object):
                     cube_prev = cube
                     continue
                 if cube.visible and cube.scale.x == 1 and cube_prev.visible and pos.x == posp.x:
-                    if (col.r, col.g, col.b) == (colp.r, colp.g, colp.b):
+                    if col is colp or (col.r, col.g, col.b) == (colp.r, colp.g, colp.b):
                         cube_prev.scale.y += 1
                         cube.visible = False
                         continue
                 cube_prev = cube
             x += 1
             
+    # Return a grid of colour keys (None for transparent) used for meshing
+    def get_colour_keys(self):
+        keys = [[None] * self.width for i in xrange(self.height)]
+        for cube in self.cubes:
+            col = cube.colour
+            if col.a > 0:
+                keys[cube.position.y][cube.position.x] = (col.r, col.g, col.b)
+        return keys
+
+    # Optimize by splitting each colour region into maximal rectangles
+    # (replaces optimize_rows and optimize_columns)
+    def optimize_greedy(self):
+        for cube in self.cubes:
+            cube.visible = False
+            cube.scale = Vector(1, 1, 1)
+        rects = greedy_rectangles(self.get_colour_keys(), self.width, self.height)
+        for x, y, w, h in rects:
+            # cubes are anchored at their bottom-left pixel
+            cube = self.cubes[(y + h - 1) * self.width + x]
+            cube.visible = True
+            cube.scale = Vector(w, h, 1)
+
     # Optimize generated faces to cut down on unnecessary drawing
     def optimize_faces(self):
-        in_pos2d = lambda x, y: (x, y) in self.positions2d
         for cube in self.cubes:
             if not cube.visible: continue
-            x, y = cube.position.x, cube.position.y
-            inc_faces = {
-                'left' : False, 'right' : False, 'top' : False, 'bottom' : False }
-            for ix in range(x, x + cube.scale.x):
-                if in_pos2d(ix-1, y):
-                    if not inc_faces['left'] and not 'left' in cube.ex_faces:
-                        cube.ex_faces.append('left')
-                else:
-                    inc_faces['left'] = True
-                    if 'left' in cube.ex_faces: cube.ex_faces.remove('left')
-                if in_pos2d(ix+1, y):
-                    if not inc_faces['right'] and not 'right' in cube.ex_faces:
-                        cube.ex_faces.append('right')
-                else:
-                    inc_faces['right'] = True
-                    if 'right' in cube.ex_faces: cube.ex_faces.remove('right')
-                if in_pos2d(ix, y-1):
-                    if not inc_faces['top'] and not 'top' in cube.ex_faces:
-                        cube.ex_faces.append('top')
-                else:
-                    inc_faces['top'] = True
-                    if 'top' in cube.ex_faces: cube.ex_faces.remove('top')
-                if in_pos2d(ix, y+1):
-                    if not inc_faces['bottom'] and not 'bottom' in cube.ex_faces:
-                        cube.ex_faces.append('bottom')
-                else:
-                    inc_faces['bottom'] = True
-                    if 'bottom' in cube.ex_faces: cube.ex_faces.remove('bottom')
-            if cube.scale.y == 1: continue
-            for iy in reversed(range((y - cube.scale.y)+1, y+1)):
-                if in_pos2d(x-1, iy):
-                    if not inc_faces['left'] and not 'left' in cube.ex_faces:
-                        cube.ex_faces.append('left')
-                else:
-                    inc_faces['left'] = True
-                    if 'left' in cube.ex_faces: cube.ex_faces.remove('left')
-                if in_pos2d(x+1, iy):
-                    if not inc_faces['right'] and not 'right' in cube.ex_faces:
-                        cube.ex_faces.append('right')
-                else:
-                    inc_faces['right'] = True
-                    if 'right' in cube.ex_faces: cube.ex_faces.remove('right')
-                if in_pos2d(x, iy-1):
-                    if not inc_faces['top'] and not 'top' in cube.ex_faces:
-                        cube.ex_faces.append('top')
-                else:
-                    inc_faces['top'] = True
-                    if 'top' in cube.ex_faces: cube.ex_faces.remove('top')
-                if in_pos2d(x, iy+1):
-                    if not inc_faces['bottom'] and not 'bottom' in cube.ex_faces:
-                        cube.ex_faces.append('bottom')
-                else:
-                    inc_faces['bottom'] = True
-                    if 'bottom' in cube.ex_faces: cube.ex_faces.remove('bottom')
-                    
+            cube.ex_faces = self.get_hidden_faces(cube.position.x, cube.position.y,
+                cube.scale.x, cube.scale.y)
+
+    # Return a Faces bitmask of the sides of a (bottom-left anchored) cube
+    # that are completely covered by neighbouring opaque pixels
+    def get_hidden_faces(self, x, y, w, h):
+        occupied = self.occupancy
+        top, x2 = y - h + 1, x + w
+        faces = 0
+        for ix in xrange(x, x2):
+            if not (ix, top - 1) in occupied: break
+        else: faces |= Faces.Top
+        for ix in xrange(x, x2):
+            if not (ix, y + 1) in occupied: break
+        else: faces |= Faces.Bottom
+        for iy in xrange(top, y + 1):
+            if not (x - 1, iy) in occupied: break
+        else: faces |= Faces.Left
+        for iy in xrange(top, y + 1):
+            if not (x2, iy) in occupied: break
+        else: faces |= Faces.Right
+        return faces
+
     # Return list of PixelCubes uses to construct the image
     def get_cubes(self):
         return self.cubes
         
+    # Set opaque (x, y) pixels outside of the image (ie. in neighbouring tiles)
+    # that faces along the image's edges are culled against
+    def set_border(self, border):
+        self.occupancy = self.positions2d | set(border)
+
+    # Return the visible cubes as (x, y, width, height, (r, g, b), faces) in row order
+    def get_boxes(self):
+        return [(cube.position.x, cube.position.y, cube.scale.x, cube.scale.y,
+            (cube.colour.r, cube.colour.g, cube.colour.b), cube.ex_faces)
+            for cube in self.get_cubes() if cube.visible]
+
     # Return the colour palette
     def get_colour_palette(self):
         return self.colour_palette
 
+    # Return the (x, y, x2, y2) bounds of all opaque pixels
+    def get_bounds(self):
+        x, y, x2, y2 = self.width + 1, self.height + 1, -1, -1
+        for px, py in self.positions2d:
+            if px < x: x = px
+            if py < y: y = py
+            if px > x2: x2 = px
+            if py > y2: y2 = py
+        return x, y, x2, y2
+
     # Optimize data such that the produced model will be semi-efficient
-    def optimize(self):
-        self.optimize_rows()
-        self.optimize_columns()
-        self.optimize_faces()
+    # mesher is either 'rows' (row then column merging) or 'greedy' (rectangles)
+    # stats (a ConversionStats) times each step and counts cubes after row merging
+    def optimize(self, mesher = 'rows', stats = None):
+        stage = stats.stage if stats else null_stage
+        if mesher == 'greedy':
+            with stage('optimize_greedy'): self.optimize_greedy()
+        else:
+            with stage('optimize_rows'): self.optimize_rows()
+            if stats: stats.counts['cubes_after_rows'] = self.count_cubes()
+            with stage('optimize_columns'): self.optimize_columns()
+        with stage('optimize_faces'): self.optimize_faces()
+
+    # Return the number of visible cubes
+    def count_cubes(self):
+        return sum(1 for cube in self.cubes if cube.visible)
+
+    # Return the number of opaque pixels
+    def count_opaque(self):
+        return len(self.positions2d)
+
+    # Return the number of triangles the model will have (two per drawn cube face)
+    def count_triangles(self, merge_faces = False):
+        boxes = self.get_boxes()
+        if merge_faces: boxes = merge_box_faces(list(boxes), self.width, self.height)
+        return sum(12 - bin(faces).count('1') * 2 for x, y, w, h, rgb, faces in boxes)
         
-    # Write the SMD model
-    def write(self, file_name, vdimensions, texture_file, uvmap, collisions = None):
-        uvcoord = lambda: uvmap[(rgba.r, rgba.g, rgba.b)]
-        mdl = Model('mdl_' + file_name)
-        cc = mdl.create(Objects.Cube)
+    # Write the SMD model, returning counts of the cubes, culled faces, triangles and bytes written
+    # (models are written to in-memory buffers instead of files if outputs is given)
+    # output_format is 'smd' or 'bin', which replaces file_name's .smd extension with .psmb
+    # pool (a multiprocessing.Pool) formats the model in parallel chunks (see SmdStream)
+    # and has the collision mesh written alongside it
+    # max_hulls and hull_tolerance select a multi-box collision mesh (see write_physics)
+    # merge_faces draws the cubes with coplanar faces merged (see merge_box_faces)
+    def write(self, file_name, vdimensions, texture_file, uvmap, collisions = None,
+            output_dir = '', outputs = None, output_format = 'smd', pool = None,
+            max_hulls = None, hull_tolerance = 0.0, merge_faces = False):
+        physics, threads = None, None
+        if not collisions == None and pool:
+            threads = ThreadPool(1)
+            physics = threads.apply_async(self.write_physics, (file_name, vdimensions,
+                texture_file, uvmap, collisions, output_dir, outputs, output_format,
+                max_hulls, hull_tolerance))
+            threads.close()
+        try:
+            with Model(output_file(model_file_name(file_name, '', output_format), output_dir,
+                    outputs), True, output_format, pool) as mdl:
+                counts = self.draw_model(mdl.create(Objects.Cube), vdimensions, texture_file,
+                    uvmap, merge_faces)
+                mdl.save()
+            counts['model_triangles'], counts['model_bytes'] = mdl.triangles, mdl.bytes
+        finally:
+            if threads: threads.join()
+        if physics:
+            counts.update(physics.get())
+        elif not collisions == None:
+            counts.update(self.write_physics(file_name, vdimensions, texture_file, uvmap,
+                collisions, output_dir, outputs, output_format, max_hulls, hull_tolerance))
+        return counts
+
+    # Draw the model with an ObjectMaker_Cube, returning counts of the cubes and culled
+    # (and merged, see merge_box_faces) faces
+    def draw_model(self, cc, vdimensions, texture_file, uvmap, merge_faces = False):
+        corners = dict((rgb, uv_corners(uvs)) for rgb, uvs in uvmap.iteritems())
+        counts = { 'cubes' : 0, 'faces_culled' : 0 }
+        boxes = self.get_boxes()
+        if merge_faces:
+            boxes = list(boxes)
+            for x, y, w, h, rgb, ex_faces in boxes:
+                counts['cubes'] += 1
+                counts['faces_culled'] += bin(ex_faces).count('1')
+            boxes = merge_box_faces(boxes, self.width, self.height)
+            counts['merged_faces'] = len(boxes)
+            self.draw_boxes(cc, boxes, vdimensions, texture_file, corners,
+                { 'cubes' : 0, 'faces_culled' : 0 })
+        else: self.draw_boxes(cc, boxes, vdimensions, texture_file, corners, counts)
+        return counts
+
+    # Return the counts write would (see write), and the number of vertices and
+    # collision boxes, without writing or formatting the model
+    def estimate(self, vdimensions, texture_file, uvmap, collisions = None,
+            output_format = 'smd', max_hulls = None, hull_tolerance = 0.0, merge_faces = False):
+        stream = BinaryMeshStream(None) if output_format == 'bin' else SmdMeasure()
+        counts = self.draw_model(Objects.Cube(stream), vdimensions, texture_file, uvmap,
+            merge_faces)
+        counts['model_triangles'] = stream.triangles
+        if output_format == 'bin':
+            counts['model_vertices'], counts['model_bytes'] = len(stream.vertex_ids), stream.measure()
+        else: counts['model_vertices'], counts['model_bytes'] = stream.triangles * 3, stream.bytes
+        if collisions == None: counts['physics_boxes'] = 0
+        elif max_hulls:
+            counts['physics_boxes'] = len(collision_boxes(self.get_boxes(), self.width,
+                self.height, max_hulls, hull_tolerance))
+        else: counts['physics_boxes'] = 1
+        return counts
+
+    # Draw boxes (see get_boxes) with an ObjectMaker_Cube, adding to counts of the
+    # cubes and culled faces (corners are the flattened UV map, see uv_corners)
+    def draw_boxes(self, cc, boxes, vdimensions, texture_file, corners, counts):
         offset = Vector(float(self.width) / 2.0, float(vdimensions.y) / 2.0, float(self.height) / 2.0)
-        x, y, x2, y2 = self.width +1 , self.height +1, -1, -1
-        for cube in self.cubes:
-            if not cube.visible:
-                pos, scale, rgba = cube.position, cube.scale, cube.colour
-                if rgba.a > 0:
-                    if pos.x < x: x = pos.x
-                    if pos.y < y: y = pos.y
-                    if pos.x > x2: x2 = pos.x
-                    if pos.y > y2: y2 = pos.y
-                continue
-            pos, scale, rgba = cube.position, cube.scale, cube.colour
-            if pos.x < x: x = pos.x
-            if pos.y < y: y = pos.y
-            if pos.x > x2: x2 = pos.x
-            if pos.y > y2: y2 = pos.y
-            pos.x -= offset.x
-            pos.y -= offset.z - 1
-            pos.z -= offset.y
-            cc.draw_cube(Vector(float(0) - offset.y, float(pos.x * vdimensions.x), float(-pos.y * vdimensions.z)),
-                Vector(float(vdimensions.y), float(vdimensions.x * scale.x), float(vdimensions.z * scale.y)),
-                texture_file, { 'top' : uvcoord(), 'bottom' : uvcoord(), 'front' : uvcoord(),
-                    'right' : uvcoord(), 'back' : uvcoord(), 'left' : uvcoord(), },
-                cube.ex_faces)
-        mdl.save()
-        if not collisions == None:
-            mdl = Model('mdl_' + file_name.replace('.smd', '') + '_phys.smd')
+        origins, sizes, uvs, faces = array('d'), array('d'), array('d'), array('i')
+        for px, py, w, h, rgb, ex_faces in boxes:
+            counts['cubes'] += 1
+            counts['faces_culled'] += bin(ex_faces).count('1')
+            px, py = px - offset.x, py - (offset.z - 1)
+            origins.extend((float(0) - offset.y, float(px * vdimensions.x), float(-py * vdimensions.z)))
+            sizes.extend((float(vdimensions.y), float(vdimensions.x * w), float(vdimensions.z * h)))
+            uvs.extend(corners[rgb])
+            faces.append(ex_faces)
+            if len(faces) >= 4096:
+                cc.draw_cubes(origins, sizes, texture_file, uvs, faces)
+                del origins[:], sizes[:], uvs[:], faces[:]
+        cc.draw_cubes(origins, sizes, texture_file, uvs, faces)
+
+    # Write the collision mesh (a single box), returning counts of its triangles and bytes
+    # If max_hulls is given, the mesh is instead at most max_hulls boxes over the opaque
+    # pixels (see collision_boxes) and collisions (the mesh scale) is ignored
+    def write_physics(self, file_name, vdimensions, texture_file, uvmap, collisions,
+            output_dir = '', outputs = None, output_format = 'smd', max_hulls = None,
+            hull_tolerance = 0.0):
+        physics_file = model_file_name(file_name, '_phys', output_format)
+        if max_hulls:
+            return self.write_hulls(physics_file, vdimensions, texture_file, uvmap,
+                output_dir, outputs, output_format, max_hulls, hull_tolerance)
+        offset = Vector(float(self.width) / 2.0, float(vdimensions.y) / 2.0, float(self.height) / 2.0)
+        x, y, x2, y2 = self.get_bounds()
+        auto_bb_collide = False
+        if collisions == 0.0:
+            auto_bb_collide = True
+            w, h = (x2-x)+1, (y2-y)+1
+            collisions = 1.0
+        else:
+            w, h = self.width, self.height
+            offset = Vector(float(w * collisions * vdimensions.x) / 2.0,
+                float(vdimensions.y) / 2.0,
+                float((h * collisions * vdimensions.z) / 2.0))
+        pos = Vector(0 if not auto_bb_collide else (x * vdimensions.x),
+            0 if not auto_bb_collide else (((self.height - y2)-1) * vdimensions.z),
+            0)
+        scale = Vector(w * collisions, vdimensions.y, h * collisions)
+        uvcoord = lambda: uvmap.values()[0]
+        pos.x -= offset.x if not auto_bb_collide else offset.x * vdimensions.x
+        pos.y -= offset.z if not auto_bb_collide else offset.z * vdimensions.z
+        pos.z -= offset.y if not auto_bb_collide else offset.y * vdimensions.y
+        with Model(output_file(physics_file, output_dir, outputs), True, output_format) as mdl:
             cc = mdl.create(Objects.Cube)
-            auto_bb_collide = False
-            if collisions == 0.0:
-                auto_bb_collide = True
-                w, h = (x2-x)+1, (y2-y)+1
-                collisions = 1.0
-            else:
-                w, h = self.width, self.height
-                offset = Vector(float(w * collisions * vdimensions.x) / 2.0,
-                    float(vdimensions.y) / 2.0,
-                    float((h * collisions * vdimensions.z) / 2.0))
-            pos = Vector(0 if not auto_bb_collide else (x * vdimensions.x),
-                0 if not auto_bb_collide else (((self.height - y2)-1) * vdimensions.z),
-                0)
-            scale = Vector(w * collisions, vdimensions.y, h * collisions)
-            uvcoord = lambda: uvmap.values()[0]
-            pos.x -= offset.x if not auto_bb_collide else offset.x * vdimensions.x
-            pos.y -= offset.z if not auto_bb_collide else offset.z * vdimensions.z
-            pos.z -= offset.y if not auto_bb_collide else offset.y * vdimensions.y
             cc.draw_cube(Vector(float(0) - offset.y, float(pos.x), float(pos.y)),
                          Vector((vdimensions.y), float(scale.x * vdimensions.x), float(scale.z * vdimensions.z)),
                 texture_file, { 'top' : uvcoord(), 'bottom' : uvcoord(), 'front' : uvcoord(),
                     'right' : uvcoord(), 'back' : uvcoord(), 'left' : uvcoord(), },
-                [])
+                0)
             mdl.save()
+        return { 'physics_triangles' : mdl.triangles, 'physics_bytes' : mdl.bytes }
+
+    # Write a collision mesh of at most max_hulls boxes (see write_physics) to the
+    # output file file_name, returning counts of its boxes, triangles and bytes
+    def write_hulls(self, file_name, vdimensions, texture_file, uvmap, output_dir, outputs,
+            output_format, max_hulls, hull_tolerance):
+        hulls = collision_boxes(self.get_boxes(), self.width, self.height, max_hulls,
+            hull_tolerance)
+        rgb = uvmap.keys()[0] if uvmap else None
+        counts = { 'cubes' : 0, 'faces_culled' : 0 }
+        with Model(output_file(file_name, output_dir, outputs), True, output_format) as mdl:
+            self.draw_boxes(mdl.create(Objects.Cube), [(x, y2 - 1, x2 - x, y2 - y, rgb, 0)
+                for x, y, x2, y2 in hulls], vdimensions, texture_file,
+                { rgb : uv_corners(uvmap[rgb]) } if uvmap else {}, counts)
+            mdl.save()
+        return { 'physics_hulls' : len(hulls), 'physics_triangles' : mdl.triangles,
+            'physics_bytes' : mdl.bytes }
         
     # Test to make sure faces are correctly optimized
     def test_render_face_visualization(self, f):
@@ -292,10 +949,10 @@ class PixelCubeImage(object):
             if not cube.scale.x > 1:
                 if not cube.scale.y > 1 and cube.visible:
                     rgb = [255,255,255]
-                    if 'left' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]]
-                    if 'right' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
-                    if 'top' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]]
-                    if 'bottom' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
+                    if cube.ex_faces & Faces.Left: rgb = [rgb[0]-80,rgb[1],rgb[2]]
+                    if cube.ex_faces & Faces.Right: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
+                    if cube.ex_faces & Faces.Top: rgb = [rgb[0], rgb[1]-80,rgb[2]]
+                    if cube.ex_faces & Faces.Bottom: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
                     pos = ((cube.position.x+1)*4)-4
                     pix2d[cube.position.y][pos] = rgb[0]
                     pix2d[cube.position.y][pos+1] = rgb[1]
@@ -304,10 +961,10 @@ class PixelCubeImage(object):
                 continue
             pos = ((cube.position.x+1) * 4)-4
             rgb = [255,255,255]
-            if 'left' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]]
-            if 'right' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
-            if 'top' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]]
-            if 'bottom' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
+            if cube.ex_faces & Faces.Left: rgb = [rgb[0]-80,rgb[1],rgb[2]]
+            if cube.ex_faces & Faces.Right: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
+            if cube.ex_faces & Faces.Top: rgb = [rgb[0], rgb[1]-80,rgb[2]]
+            if cube.ex_faces & Faces.Bottom: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
             for i in range(pos, pos + cube.scale.x * 4, 4):
                 pix2d[cube.position.y][i] = rgb[0]
                 pix2d[cube.position.y][i+1] = rgb[1]
@@ -316,10 +973,10 @@ class PixelCubeImage(object):
         for cube in self.cubes:
             if cube.scale.y > 1:
                 rgb = [255,255,255]
-                if 'left' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]]
-                if 'right' in cube.ex_faces: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
-                if 'top' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]]
-                if 'bottom' in cube.ex_faces: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
+                if cube.ex_faces & Faces.Left: rgb = [rgb[0]-80,rgb[1],rgb[2]]
+                if cube.ex_faces & Faces.Right: rgb = [rgb[0]-80,rgb[1],rgb[2]-80]
+                if cube.ex_faces & Faces.Top: rgb = [rgb[0], rgb[1]-80,rgb[2]]
+                if cube.ex_faces & Faces.Bottom: rgb = [rgb[0], rgb[1]-80,rgb[2]-80]
                 for y in range(0, cube.scale.y):
                     pix2d[cube.position.y-y][((cube.position.x+1)*4)-4] = rgb[0]
                     pix2d[cube.position.y-y][(((cube.position.x+1)*4)-4)+1] = rgb[1]
@@ -360,57 +1017,833 @@ class PixelCubeImage(object):
                 pix2d[cube.position.y][((cube.position.x+1) * 4)-1] = cube.colour.a
         png.from_array(pix2d, 'RGBA').save(f)
         
+# PixelCubeImage backed by NumPy arrays rather than a PixelCube per pixel
+# Produces exactly the same cubes and faces as PixelCubeImage
+class PixelCubeArrayImage(PixelCubeImage):
+
+    # Constructor: Create colour/alpha arrays from an RgbaPngImage8 image
+    def __init__(self, img):
+        if numpy is None:
+            raise Exception('The numpy engine requires NumPy to be installed')
+        self.original_file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        self.indices = None
+        if getattr(img, 'palette', None) is None:
+            rows = [numpy.asarray(row, dtype = numpy.uint8) for row in img.image]
+            if len(rows) < self.height or [r for r in rows if len(r) < self.width * 4]:
+                raise Exception('Unexpected end-of-file')
+            self.rgba = numpy.vstack(rows).reshape(self.height, self.width, 4)
+            rgba = self.rgba.astype(numpy.uint32)
+            self.keys = (rgba[:, :, 0] << 16) | (rgba[:, :, 1] << 8) | rgba[:, :, 2]
+        else: self.read_indexed(img)
+        self.opaque = self.rgba[:, :, 3] > 0
+        self.scale_x = numpy.zeros((self.height, self.width), dtype = numpy.int32)
+        self.scale_y = numpy.zeros((self.height, self.width), dtype = numpy.int32)
+        self.visible = numpy.zeros((self.height, self.width), dtype = bool)
+        self.ex_faces = numpy.zeros((self.height, self.width), dtype = numpy.int32)
+        self.colour_palette = {}
+        self.cubes = None
+        self.border = ()
+        self.create_palette()
+
+    # Create the arrays from the rows of palette indices of an indexed image, with
+    # the index of each pixel's distinct colour (in the palette) as its key
+    def read_indexed(self, img):
+        rows = [numpy.frombuffer(bytearray(row), dtype = numpy.uint8) for row in img.indices]
+        if len(rows) < self.height or [r for r in rows if len(r) < self.width]:
+            raise Exception('Unexpected end-of-file')
+        self.indices = numpy.vstack(rows)[:, :self.width]
+        palette = numpy.array(img.palette, dtype = numpy.uint8)
+        rgb = palette.astype(numpy.uint32)
+        packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        colours = numpy.unique(packed, return_inverse = True)[1]
+        self.rgba = palette[self.indices]
+        self.keys = colours[self.indices]
+
+    # Fill the colour palette in the same (first occurrence) order as PixelCubeImage
+    def create_palette(self):
+        flat = self.rgba.reshape(-1, 4).astype(numpy.uint32)
+        if self.indices is None:
+            packed = (flat[:, 0] << 24) | (flat[:, 1] << 16) | (flat[:, 2] << 8) | flat[:, 3]
+        else: packed = self.indices.ravel()
+        if not len(packed): return
+        unique, first = numpy.unique(packed, return_index = True)
+        for i in numpy.sort(first).tolist():
+            self.get_rgba_from_palette(*flat[i].tolist())
+
+    # Optimize for adjacent rows of the same colour (as runs along each row)
+    def optimize_rows(self):
+        cont = numpy.zeros(self.opaque.shape, dtype = bool)
+        cont[:, 1:] = (self.opaque[:, 1:] & self.opaque[:, :-1] &
+            (self.keys[:, 1:] == self.keys[:, :-1]))
+        start = self.opaque & ~cont
+        breaks = numpy.flatnonzero(~cont)
+        ends = numpy.append(breaks[1:], cont.size)
+        is_start = start.flat[breaks]
+        self.scale_x[:] = 0
+        self.scale_x.flat[breaks[is_start]] = (ends - breaks)[is_start]
+        self.scale_y[:] = start
+        self.visible[:] = start
+
+    # Optimize for adjacent columns of the same colour (as runs up each column)
+    def optimize_columns(self):
+        single = (self.visible & (self.scale_x == 1)).T
+        keys = self.keys.T
+        cont = numpy.zeros(single.shape, dtype = bool)
+        cont[:, 1:] = single[:, 1:] & single[:, :-1] & (keys[:, 1:] == keys[:, :-1])
+        breaks = numpy.flatnonzero(~cont)
+        ends = numpy.append(breaks[1:], cont.size)
+        is_start = single.flat[breaks]
+        tops, bottoms = breaks[is_start], ends[is_start] - 1
+        # the bottom cube of each column run is the one left visible
+        visible = numpy.ascontiguousarray(self.visible.T)
+        scale_y = numpy.ascontiguousarray(self.scale_y.T)
+        visible[single] = False
+        visible.flat[bottoms] = True
+        scale_y.flat[bottoms] = bottoms - tops + 1
+        self.visible[:] = visible.T
+        self.scale_y[:] = scale_y.T
+
+    # Return a grid of colour keys (None for transparent) used for meshing
+    def get_colour_keys(self):
+        keys = numpy.where(self.opaque, self.keys, -1).tolist()
+        return [[None if key < 0 else key for key in row] for row in keys]
+
+    # Optimize by splitting each colour region into maximal rectangles
+    def optimize_greedy(self):
+        self.visible[:] = False
+        self.scale_x[:] = 0
+        self.scale_y[:] = 0
+        rects = greedy_rectangles(self.get_colour_keys(), self.width, self.height)
+        for x, y, w, h in rects:
+            self.visible[y + h - 1, x] = True
+            self.scale_x[y + h - 1, x] = w
+            self.scale_y[y + h - 1, x] = h
+
+    # Optimize generated faces to cut down on unnecessary drawing
+    def optimize_faces(self):
+        h, w = self.opaque.shape
+        occupied = numpy.zeros((h + 2, w + 2), dtype = numpy.int32)
+        occupied[1:-1, 1:-1] = self.opaque
+        for x, y in self.border:
+            occupied[y + 1, x + 1] = 1
+        rows = numpy.zeros((h + 2, w + 3), dtype = numpy.int32)
+        rows[:, 1:] = numpy.cumsum(occupied, axis = 1)
+        cols = numpy.zeros((h + 3, w + 2), dtype = numpy.int32)
+        cols[1:, :] = numpy.cumsum(occupied, axis = 0)
+        y, x = numpy.nonzero(self.visible)
+        sx, sy = self.scale_x[y, x], self.scale_y[y, x]
+        top, x2 = y - sy + 1, x + sx
+        # indices are shifted by one to account for the empty border
+        faces = numpy.zeros(len(y), dtype = numpy.int32)
+        faces |= numpy.where(rows[top, x2 + 1] - rows[top, x + 1] == sx, Faces.Top, 0)
+        faces |= numpy.where(rows[y + 2, x2 + 1] - rows[y + 2, x + 1] == sx, Faces.Bottom, 0)
+        faces |= numpy.where(cols[y + 2, x] - cols[top + 1, x] == sy, Faces.Left, 0)
+        faces |= numpy.where(cols[y + 2, x2 + 1] - cols[top + 1, x2 + 1] == sy, Faces.Right, 0)
+        self.ex_faces[:] = 0
+        self.ex_faces[y, x] = faces
+
+    # Set opaque (x, y) pixels outside of the image that edge faces are culled against
+    def set_border(self, border):
+        self.border = list(border)
+
+    # Optimize data such that the produced model will be semi-efficient
+    def optimize(self, mesher = 'rows', stats = None):
+        PixelCubeImage.optimize(self, mesher, stats)
+        self.cubes = None
+
+    # Return the number of visible cubes
+    def count_cubes(self):
+        return int(self.visible.sum())
+
+    # Return the number of opaque pixels
+    def count_opaque(self):
+        return int(self.opaque.sum())
+
+    # Return list of visible PixelCubes (in row order) used to construct the image
+    def get_cubes(self):
+        if self.cubes is None:
+            self.cubes = []
+            y, x = numpy.nonzero(self.visible)
+            keys = self.rgba[y, x].tolist()
+            for cx, cy, sx, sy, key, faces in zip(x.tolist(), y.tolist(),
+                    self.scale_x[y, x].tolist(), self.scale_y[y, x].tolist(),
+                    keys, self.ex_faces[y, x].tolist()):
+                cube = PixelCube(Vector(cx, cy, 0), self.colour_palette[tuple(key)])
+                cube.scale = Vector(sx, sy, 1)
+                cube.ex_faces = faces
+                self.cubes.append(cube)
+        return self.cubes
+
+    # Return the visible cubes as (x, y, width, height, (r, g, b), faces) in row order
+    def get_boxes(self):
+        y, x = numpy.nonzero(self.visible)
+        rgb = [tuple(c) for c in self.rgba[y, x, :3].tolist()]
+        return zip(x.tolist(), y.tolist(), self.scale_x[y, x].tolist(),
+            self.scale_y[y, x].tolist(), rgb, self.ex_faces[y, x].tolist())
+
+    # Return the (x, y, x2, y2) bounds of all opaque pixels
+    def get_bounds(self):
+        y, x = numpy.nonzero(self.opaque)
+        if not len(x): return self.width + 1, self.height + 1, -1, -1
+        return int(x.min()), int(y.min()), int(x.max()), int(y.max())
+
+    # Test to make sure ALL image data is stored correctly
+    def test_render_image(self, f):
+        pix = self.rgba * self.opaque[:, :, numpy.newaxis]
+        png.from_array(pix.reshape(self.height, self.width * 4).tolist(), 'RGBA').save(f)
+
+# PixelCubeImage that streams rows from the PNG file rather than holding the image
+# The file is read twice: once for the palette and bounds, then again while
+# meshing, keeping only the rows needed for merging and face culling (so memory
+# depends on image width). Produces the same cubes as PixelCubeImage's rows mesher
+class StreamingPixelCubeImage(PixelCubeImage):
+    Meshers = ('rows',)
+
+    # Constructor: Collect the colour palette and bounds from an RgbaPngImage8 image
+    def __init__(self, img):
+        self.img = img
+        self.original_file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        self.colour_palette = {}
+        self.bounds = (self.width + 1, self.height + 1, -1, -1)
+        x, y, x2, y2 = self.bounds
+        rows, self.opaque = 0, 0
+        for row in img.image:
+            if len(row) < self.width * 4: raise Exception('Unexpected end-of-file')
+            for i in xrange(0, self.width * 4, 4):
+                rgba = self.get_rgba_from_palette(row[i], row[i+1], row[i+2], row[i+3])
+                if rgba.a == 0: continue
+                self.opaque += 1
+                if i // 4 < x: x = i // 4
+                if i // 4 > x2: x2 = i // 4
+                if rows < y: y = rows
+                y2 = rows
+            rows += 1
+        if rows < self.height: raise Exception('Unexpected end-of-file')
+        self.bounds = (x, y, x2, y2)
+
+    # Merging happens while the rows are streamed (see get_boxes)
+    def optimize(self, mesher = 'rows', stats = None):
+        if not mesher == 'rows':
+            raise ValueError('Streaming only supports the rows mesher')
+
+    # Return the number of opaque pixels
+    def count_opaque(self):
+        return self.opaque
+
+    # Return the opaque pixels and (x, width, (r, g, b)) same colour runs of a row
+    def scan_row(self, row):
+        if len(row) < self.width * 4: raise Exception('Unexpected end-of-file')
+        occupied, spans, prev = [False] * self.width, [], None
+        for x in xrange(self.width):
+            i = x * 4
+            if row[i+3] == 0:
+                prev = None
+                continue
+            occupied[x] = True
+            rgb = (row[i], row[i+1], row[i+2])
+            if rgb == prev: spans[-1][1] += 1
+            else:
+                spans.append([x, 1, rgb])
+                prev = rgb
+        return occupied, spans
+
+    # Yield the visible cubes as (x, y, width, height, (r, g, b), faces) in row order
+    # Cubes anchored on a row are finished once the following row has been read
+    def get_boxes(self):
+        rows = iter(self.img.read_rows())
+        width, stacks = self.width, {}
+        prev, cur, nxt = None, None, None
+        for y in xrange(self.height):
+            if cur is None:
+                cur = self.scan_row(next(rows, ()))
+            nxt = self.scan_row(next(rows, ())) if y + 1 < self.height else None
+            occupied, spans = cur
+            next_single = nxt and dict((x, rgb) for x, w, rgb in nxt[1] if w == 1) or {}
+            open_stacks = {}
+            for x, w, rgb in spans:
+                below = nxt and not False in nxt[0][x:x+w]
+                left = x > 0 and occupied[x-1]
+                right = x + w < width and occupied[x+w]
+                if w > 1:
+                    faces = 0
+                    if prev and not False in prev[x:x+w]: faces |= Faces.Top
+                    if below: faces |= Faces.Bottom
+                    if left: faces |= Faces.Left
+                    if right: faces |= Faces.Right
+                    yield (x, y, w, 1, rgb, faces)
+                    continue
+                # [top row, covered above, covered left, covered right]
+                stack = stacks.get(x) or [y, bool(prev and prev[x]), True, True]
+                stack[2] = stack[2] and left
+                stack[3] = stack[3] and right
+                if next_single.get(x) == rgb:
+                    open_stacks[x] = stack
+                    continue
+                faces = 0
+                if stack[1]: faces |= Faces.Top
+                if below: faces |= Faces.Bottom
+                if stack[2]: faces |= Faces.Left
+                if stack[3]: faces |= Faces.Right
+                yield (x, y, 1, y - stack[0] + 1, rgb, faces)
+            stacks = open_stacks
+            prev, cur = occupied, nxt
+
+    # Return list of visible PixelCubes (in row order) used to construct the image
+    def get_cubes(self):
+        cubes = []
+        for x, y, w, h, rgb, faces in self.get_boxes():
+            cube = PixelCube(Vector(x, y, 0), RGBA(*rgb))
+            cube.scale = Vector(w, h, 1)
+            cube.ex_faces = faces
+            cubes.append(cube)
+        return cubes
+
+    # Return the (x, y, x2, y2) bounds of all opaque pixels
+    def get_bounds(self):
+        return self.bounds
+
+# PixelCubeImage that re-meshes only what changed since its previous conversion
+# The decoded rows and where each row's cubes were written in the model are kept in
+# a sidecar (mdl_<name>.inc). Cubes anchored on rows near changed pixels (or on
+# stacks passing them) are re-meshed and spliced between the unchanged rows' model
+# data. Produces the same model as PixelCubeImage's rows mesher (see verify), and falls
+# back to a full conversion if the size, colours (UV map) or parameters have changed
+# The sidecar is a line of JSON (the version, a digest of the parameters, the model's
+# size and mtime, and the row chunks) followed by the raw RGBA rows
+class IncrementalPixelCubeImage(PixelCubeImage):
+    SidecarVersion = 2
+    Meshers = ('rows',)
+
+    # Constructor: Decode an RgbaPngImage8 image's rows and collect its colour palette
+    def __init__(self, img):
+        self.original_file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        self.rows = [bytearray(row) for row in img.image]
+        if len(self.rows) < self.height or min(len(row) for row in self.rows) < self.width * 4:
+            raise Exception('Unexpected end-of-file')
+        self.colour_palette = read_palette(self.rows, self.width)
+
+    # Re-meshing only supports row then column merging
+    def optimize(self, mesher = 'rows', stats = None):
+        if not mesher == 'rows':
+            raise ValueError('Incremental conversion only supports the rows mesher')
+
+    # Return the number of opaque pixels
+    def count_opaque(self):
+        return sum(self.width - row[3::4].count('\0') for row in self.rows)
+
+    # Return the (x, y, x2, y2) bounds of all opaque pixels
+    def get_bounds(self):
+        x, y, x2, y2 = self.width + 1, self.height + 1, -1, -1
+        for iy, row in enumerate(self.rows):
+            alpha = row[3:self.width * 4:4]
+            if alpha.count('\0') == self.width: continue
+            x = min(x, self.width - len(alpha.lstrip('\0')))
+            x2 = max(x2, len(alpha.rstrip('\0')) - 1)
+            y, y2 = min(y, iy), iy
+        return x, y, x2, y2
+
+    # Return the (r, g, b) of a pixel if it is a run of its own (see optimize_rows)
+    def get_single(self, row, x):
+        i = x * 4
+        if row[i+3] == 0: return None
+        rgb = row[i:i+3]
+        if x > 0 and row[i-1] and row[i-4:i-1] == rgb: return None
+        if x + 1 < self.width and row[i+7] and row[i+4:i+7] == rgb: return None
+        return tuple(rgb)
+
+    # Return the row a pixel's column stack (see optimize_columns) is anchored on
+    def get_stack_anchor(self, rows, x, y):
+        rgb = self.get_single(rows[y], x)
+        if rgb is None: return None
+        while y + 1 < self.height and self.get_single(rows[y+1], x) == rgb:
+            y += 1
+        return y
+
+    # Return the visible cubes anchored on a row as (x, y, width, height, (r, g, b), faces)
+    def get_row_boxes(self, y):
+        rows, width = self.rows, self.width
+        row = rows[y]
+        above = rows[y-1] if y > 0 else None
+        below = rows[y+1] if y + 1 < self.height else None
+        spans, prev = [], None
+        for x in xrange(width):
+            i = x * 4
+            if row[i+3] == 0:
+                prev = None
+                continue
+            rgb = tuple(row[i:i+3])
+            if rgb == prev: spans[-1][1] += 1
+            else:
+                spans.append([x, 1, rgb])
+                prev = rgb
+        boxes = []
+        for x, w, rgb in spans:
+            i, i2 = x * 4, (x + w) * 4
+            faces = 0
+            if below and not below[i+3:i2:4].count('\0'): faces |= Faces.Bottom
+            if w > 1:
+                if above and not above[i+3:i2:4].count('\0'): faces |= Faces.Top
+                if x > 0 and row[i-1]: faces |= Faces.Left
+                if x + w < width and row[i2+3]: faces |= Faces.Right
+                boxes.append((x, y, w, 1, rgb, faces))
+                continue
+            # single pixel runs stack upwards while the pixels above are too
+            if below and self.get_single(below, x) == rgb: continue
+            top = y
+            while top > 0 and self.get_single(rows[top-1], x) == rgb:
+                top -= 1
+            if top > 0 and rows[top-1][i+3]: faces |= Faces.Top
+            if x > 0 and all(rows[iy][i-1] for iy in xrange(top, y + 1)): faces |= Faces.Left
+            if x + 1 < width and all(rows[iy][i+7] for iy in xrange(top, y + 1)):
+                faces |= Faces.Right
+            boxes.append((x, y, 1, y - top + 1, rgb, faces))
+        return boxes
+
+    # Yield the visible cubes as (x, y, width, height, (r, g, b), faces) in row order
+    def get_boxes(self):
+        for y in xrange(self.height):
+            for box in self.get_row_boxes(y):
+                yield box
+
+    # Return the rows with cubes that may differ from the previous rows' cubes
+    def get_changed_rows(self, previous):
+        rows, changed = self.rows, set()
+        for y in xrange(self.height):
+            if rows[y] == previous[y]: continue
+            row, old = rows[y], previous[y]
+            xs = set()
+            for x in xrange(self.width):
+                if not row[x*4:x*4+4] == old[x*4:x*4+4]:
+                    xs.update((x - 1, x, x + 1))
+            # rows sharing faces with the changed pixels, and any stacks passing them
+            for iy in (y - 1, y, y + 1):
+                if not 0 <= iy < self.height: continue
+                changed.add(iy)
+                for x in xs:
+                    if not 0 <= x < self.width: continue
+                    for image in (rows, previous):
+                        anchor = self.get_stack_anchor(image, x, iy)
+                        if not anchor is None: changed.add(anchor)
+        return changed
+
+    # Return the previous conversion's sidecar if it can be patched to match this one
+    def read_sidecar(self, sidecar_file, model_file, params):
+        try:
+            with open(sidecar_file, 'rb') as f:
+                sidecar = json.loads(f.readline())
+                sidecar['rows'] = f.read()
+            model = os.stat(model_file)
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+        if not sidecar.get('version') == [VERSION, IncrementalPixelCubeImage.SidecarVersion]:
+            return None
+        if not sidecar.get('params') == params: return None
+        if not sidecar.get('model') == [model.st_size, model.st_mtime]: return None
+        chunks = sidecar.get('chunks')
+        if not len(sidecar['rows']) == self.width * self.height * 4: return None
+        if not isinstance(chunks, list) or not len(chunks) == self.height: return None
+        for chunk in chunks:
+            if not (isinstance(chunk, list) and len(chunk) == 5 and
+                    all(isinstance(v, (int, long)) and v >= 0 for v in chunk)):
+                return None
+        return sidecar
+
+    # Write the sidecar of a model written with params (see read_sidecar)
+    def write_sidecar(self, sidecar_file, model_file, params, chunks):
+        model = os.stat(model_file)
+        with open(sidecar_file, 'wb') as f:
+            json.dump({ 'version' : [VERSION, IncrementalPixelCubeImage.SidecarVersion],
+                'params' : params, 'model' : [model.st_size, model.st_mtime],
+                'chunks' : chunks }, f, separators = (',', ':'))
+            f.write('\n')
+            for row in self.rows:
+                f.write(row)
+
+    # Raise an exception unless the model written to output_dir is byte for byte the
+    # model PixelCubeImage's rows mesher converts this image to
+    def verify(self, file_name, vdimensions, texture_file, uvmap, output_dir = ''):
+        model_file = model_file_name(file_name)
+        full, outputs = PixelCubeImage(RgbaImageRegion(self.rows, self.original_file_name,
+            0, 0, self.width, self.height)), {}
+        full.optimize('rows')
+        full.write(file_name, vdimensions, texture_file, uvmap, outputs = outputs)
+        with open(os.path.join(output_dir, model_file)) as f:
+            if not f.read() == outputs[model_file].getvalue():
+                raise Exception('Incremental model %s differs from a full conversion' %
+                    model_file)
+
+    # Write the SMD model, re-meshing only the rows that changed since the previous
+    # conversion written to output_dir (see PixelCubeImage.write)
+    def write(self, file_name, vdimensions, texture_file, uvmap, collisions = None,
+            output_dir = '', outputs = None, output_format = 'smd', pool = None,
+            max_hulls = None, hull_tolerance = 0.0, merge_faces = False):
+        if not outputs is None or not output_format == 'smd' or merge_faces:
+            return PixelCubeImage.write(self, file_name, vdimensions, texture_file, uvmap,
+                collisions, output_dir, outputs, output_format, pool, max_hulls, hull_tolerance,
+                merge_faces)
+        model_file = os.path.join(output_dir, model_file_name(file_name))
+        sidecar_file = os.path.join(output_dir, 'mdl_' + file_name.replace('.smd', '') + '.inc')
+        corners = dict((rgb, uv_corners(uvs)) for rgb, uvs in uvmap.iteritems())
+        params = hashlib.sha1(repr((self.width, self.height,
+            (vdimensions.x, vdimensions.y, vdimensions.z), texture_file,
+            sorted(corners.iteritems())))).hexdigest()
+        sidecar = self.read_sidecar(sidecar_file, model_file, params)
+        if sidecar:
+            stride = self.width * 4
+            previous = [bytearray(sidecar['rows'][y*stride:(y+1)*stride])
+                for y in xrange(self.height)]
+            changed = self.get_changed_rows(previous)
+            with open(model_file) as f:
+                data = f.read()
+        else: changed = xrange(self.height)
+        # (offset, length, cubes, culled faces, triangles) of each row's model data
+        # The model is read and written in text mode as PixelCubeImage.write writes it,
+        # so offsets are into its text (with newlines whatever the platform's line endings)
+        chunks = sidecar['chunks'] if sidecar else [None] * self.height
+        meshed = {}
+        for y in changed:
+            cc = Objects.Cube()
+            row_counts = { 'cubes' : 0, 'faces_culled' : 0 }
+            self.draw_boxes(cc, self.get_row_boxes(y), vdimensions, texture_file, corners,
+                row_counts)
+            meshed[y] = cc.get_triangles()
+            chunks[y] = (None, len(meshed[y]), row_counts['cubes'], row_counts['faces_culled'],
+                len(cc.triangles))
+        counts = { 'cubes' : 0, 'faces_culled' : 0, 'model_triangles' : 0,
+            'rows_remeshed' : len(changed) }
+        offset = len(Meta.Header)
+        with open(model_file, 'w') as f:
+            f.write(Meta.Header)
+            for y, (start, length, cubes, faces_culled, triangles) in enumerate(chunks):
+                f.write(meshed[y] if y in meshed else data[start:start + length])
+                chunks[y] = (offset, length, cubes, faces_culled, triangles)
+                offset += length
+                counts['cubes'] += cubes
+                counts['faces_culled'] += faces_culled
+                counts['model_triangles'] += triangles
+            f.write(Meta.Footer)
+        counts['model_bytes'] = offset + len(Meta.Footer)
+        self.write_sidecar(sidecar_file, model_file, params, chunks)
+        if not collisions == None:
+            counts.update(self.write_physics(file_name, vdimensions, texture_file, uvmap,
+                collisions, output_dir, max_hulls = max_hulls, hull_tolerance = hull_tolerance))
+        return counts
+
+# Return (x, x2) spans with any touching or overlapping spans joined, in order
+def join_spans(spans):
+    joined = []
+    for x, x2 in sorted(spans):
+        if joined and x <= joined[-1][1]:
+            if x2 > joined[-1][1]: joined[-1] = (joined[-1][0], x2)
+        else: joined.append((x, x2))
+    return joined
+
+# PixelCubeImage holding only the opaque pixels of each row, as (x, width, (r, g, b))
+# runs of the same colour and (x, x2) spans of any colour. Transparent pixels are
+# skipped as they are read, so merging, face culling and writing depend on the opaque
+# content rather than the image size. Produces the same cubes as PixelCubeImage
+class SparsePixelCubeImage(PixelCubeImage):
+    OpaqueSpan = re.compile('[^\0]+')
+    SameRun = re.compile('(.)\\1*', re.S)
+
+    # Constructor: Read the opaque runs of an RgbaPngImage8 image
+    def __init__(self, img):
+        self.original_file_name = img.file_name
+        self.width, self.height = img.width, img.height
+        self.colour_palette = {}
+        self.runs, self.spans = [], []
+        self.opaque = 0
+        if getattr(img, 'palette', None) is None:
+            rows = (self.scan_row(bytearray(row)) for row in img.image)
+        else: rows = self.scan_indexed(img)
+        for runs, spans in rows:
+            self.runs.append(runs)
+            self.spans.append(spans)
+        if len(self.runs) < self.height: raise Exception('Unexpected end-of-file')
+        self.occupancy = dict((y, spans) for y, spans in enumerate(self.spans) if spans)
+        self.boxes = []
+
+    # Add the colours of a row of transparent pixels to the palette
+    def scan_transparent(self, row, x, x2):
+        pixels = row[x*4:x2*4]
+        if pixels.count('\0') == len(pixels):
+            if pixels: self.get_rgba_from_palette(0, 0, 0, 0)
+            return
+        for i in xrange(0, len(pixels), 4):
+            self.get_rgba_from_palette(*pixels[i:i+4])
+
+    # Return the same colour runs and opaque spans of a row, adding its colours to the
+    # palette in the same (first occurrence) order as PixelCubeImage
+    def scan_row(self, row):
+        if len(row) < self.width * 4: raise Exception('Unexpected end-of-file')
+        runs, spans, x = [], [], 0
+        for match in self.OpaqueSpan.finditer(str(row[3:self.width * 4:4])):
+            x1, x2 = match.span()
+            self.scan_transparent(row, x, x1)
+            prev = None
+            for ix in xrange(x1, x2):
+                i = ix * 4
+                rgb = self.get_rgba_from_palette(row[i], row[i+1], row[i+2], row[i+3])
+                rgb = (rgb.r, rgb.g, rgb.b)
+                if rgb == prev: runs[-1][1] += 1
+                else:
+                    runs.append([ix, 1, rgb])
+                    prev = rgb
+            spans.append((x1, x2))
+            self.opaque += x2 - x1
+            x = x2
+        self.scan_transparent(row, x, self.width)
+        return runs, spans
+
+    # Yield the same colour runs and opaque spans (see scan_row) of each row of palette
+    # indices of an indexed image, comparing the indices of the palette's distinct colours
+    def scan_indexed(self, img):
+        palette = img.palette
+        rgbs = [rgba[:3] for rgba in palette]
+        # translation tables from each index to its alpha and distinct colour
+        # (indices outside of the palette fail as they're added to the colour palette)
+        opaque = ''.join('\1' if rgba[3] else '\0' for rgba in palette).ljust(256, '\0')
+        colours = ''.join(chr(rgbs.index(rgb)) for rgb in rgbs).ljust(256, '\0')
+        def add(idx):
+            self.get_rgba_from_palette(*palette[idx])
+        for row in scan_indices(img.indices, self.width, add):
+            row = str(bytearray(row[:self.width]))
+            keys, runs, spans = row.translate(colours), [], []
+            for match in self.OpaqueSpan.finditer(row.translate(opaque)):
+                x1, x2 = match.span()
+                for run in self.SameRun.finditer(keys, x1, x2):
+                    runs.append([run.start(), run.end() - run.start(), rgbs[ord(run.group(1))]])
+                spans.append((x1, x2))
+                self.opaque += x2 - x1
+            yield runs, spans
+
+    # Optimize for adjacent rows of the same colour (each run is a cube)
+    def optimize_rows(self):
+        self.boxes = [(x, y, w, 1, rgb, 0) for y, runs in enumerate(self.runs)
+            for x, w, rgb in runs]
+
+    # Optimize for adjacent columns of the same colour (single pixel runs stack
+    # downwards, anchored on their bottom pixel)
+    def optimize_columns(self):
+        boxes, stacks = [], {}
+        for box in self.boxes:
+            x, y, w, h, rgb, faces = box
+            if w == 1:
+                stack = stacks.get(x)
+                if stack and stack[1] == y - 1 and stack[4] == rgb:
+                    boxes[stack[6]] = None
+                    box = (x, y, 1, stack[3] + 1, rgb, faces)
+                stacks[x] = box + (len(boxes),)
+            boxes.append(box)
+        self.boxes = [box for box in boxes if box]
+
+    # Return whether pixels x to x2 (exclusive) of row y are all opaque
+    def is_covered(self, y, x, x2):
+        spans = self.occupancy.get(y)
+        if not spans: return False
+        i = bisect.bisect_right(spans, (x, sys.maxint)) - 1
+        return i >= 0 and spans[i][1] >= x2
+
+    # Optimize by splitting each colour region into maximal rectangles (see
+    # greedy_rectangles) without expanding the runs into a grid
+    def optimize_greedy(self):
+        done = [set() for i in xrange(self.height)]
+        starts = [[run[0] for run in runs] for runs in self.runs]
+        boxes = []
+        for y, runs in enumerate(self.runs):
+            for rx, rw, rgb in runs:
+                x = rx
+                while x < rx + rw:
+                    if x in done[y]:
+                        x += 1
+                        continue
+                    w = 1
+                    while x + w < rx + rw and not x + w in done[y]:
+                        w += 1
+                    h = 1
+                    while y + h < self.height:
+                        i = bisect.bisect_right(starts[y+h], x) - 1
+                        if i < 0: break
+                        bx, bw, brgb = self.runs[y+h][i]
+                        if not brgb == rgb or bx + bw < x + w: break
+                        if [ix for ix in xrange(x, x + w) if ix in done[y+h]]: break
+                        h += 1
+                    for iy in xrange(y + 1, y + h):
+                        done[iy].update(xrange(x, x + w))
+                    boxes.append((x, y + h - 1, w, h, rgb, 0))
+                    x += w
+        self.boxes = sorted(boxes, key = lambda box: (box[1], box[0]))
+
+    # Optimize generated faces to cut down on unnecessary drawing
+    def optimize_faces(self):
+        self.boxes = [(x, y, w, h, rgb, self.get_hidden_faces(x, y, w, h))
+            for x, y, w, h, rgb, faces in self.boxes]
+
+    # Return a Faces bitmask of the sides of a (bottom-left anchored) cube
+    # that are completely covered by neighbouring opaque pixels
+    def get_hidden_faces(self, x, y, w, h):
+        top, x2 = y - h + 1, x + w
+        faces = 0
+        if self.is_covered(top - 1, x, x2): faces |= Faces.Top
+        if self.is_covered(y + 1, x, x2): faces |= Faces.Bottom
+        for iy in xrange(top, y + 1):
+            if not self.is_covered(iy, x - 1, x): break
+        else: faces |= Faces.Left
+        for iy in xrange(top, y + 1):
+            if not self.is_covered(iy, x2, x2 + 1): break
+        else: faces |= Faces.Right
+        return faces
+
+    # Set opaque (x, y) pixels outside of the image that edge faces are culled against
+    def set_border(self, border):
+        rows = {}
+        for x, y in border:
+            rows.setdefault(y, []).append((x, x + 1))
+        self.occupancy = dict((y, spans) for y, spans in enumerate(self.spans) if spans)
+        for y, spans in rows.iteritems():
+            self.occupancy[y] = join_spans(self.occupancy.get(y, []) + spans)
+
+    # Return the number of visible cubes
+    def count_cubes(self):
+        return len(self.boxes)
+
+    # Return the number of opaque pixels
+    def count_opaque(self):
+        return self.opaque
+
+    # Return list of visible PixelCubes (in row order) used to construct the image
+    def get_cubes(self):
+        cubes = []
+        for x, y, w, h, rgb, faces in self.boxes:
+            cube = PixelCube(Vector(x, y, 0), RGBA(*rgb))
+            cube.scale = Vector(w, h, 1)
+            cube.ex_faces = faces
+            cubes.append(cube)
+        return cubes
+
+    # Return the visible cubes as (x, y, width, height, (r, g, b), faces) in row order
+    def get_boxes(self):
+        return self.boxes
+
+    # Return the (x, y, x2, y2) bounds of all opaque pixels
+    def get_bounds(self):
+        rows = [y for y, spans in enumerate(self.spans) if spans]
+        if not rows: return self.width + 1, self.height + 1, -1, -1
+        return (min(self.spans[y][0][0] for y in rows), rows[0],
+            max(self.spans[y][-1][1] for y in rows) - 1, rows[-1])
+
+    # Test to make sure ALL image data is stored correctly
+    def test_render_image(self, f):
+        pix2d = [[0] * (self.width * 4) for i in xrange(self.height)]
+        for y, runs in enumerate(self.runs):
+            for x, w, rgb in runs:
+                pix2d[y][x*4:(x+w)*4] = list(rgb + (255,)) * w
+        png.from_array(pix2d, 'RGBA').save(f)
+
+# Meshers selectable from the command line (--mesher), each engine's Meshers being
+# those it supports
+Meshers = ('rows', 'greedy')
+
+# Image engines selectable from the command line (--engine)
+Engines = {
+    'object' : PixelCubeImage,
+    'numpy' : PixelCubeArrayImage,
+    'stream' : StreamingPixelCubeImage,
+    'incremental' : IncrementalPixelCubeImage,
+    'sparse' : SparsePixelCubeImage,
+}
+
+# Images of at least this many pixels are written with a process pool (see convert's jobs)
+ParallelWritePixels = 256 * 256
+
+# Model file extensions of each output format (--format)
+Extensions = { 'smd' : '.smd', 'bin' : '.psmb' }
+
 # Generates a texture containing image colours and maps UV co-ordinates to them
+# Colours are packed into a square (power-of-two) texture, one cell per colour, where
+# a cell is a block_size block surrounded by padding pixels of the same colour
 class ImageColoursUVMap(object):
 
     # Constructor: Create textures/UV map from a list of container colours
-    def __init__(self, texture_name, texture_colours):
+    # (the texture is only laid out, not drawn or written, unless render is set)
+    def __init__(self, texture_name, texture_colours, output_dir = '', block_size = 16, padding = 0,
+            outputs = None, render = True):
         self.file_name = 'tex_' + texture_name
+        self.output_dir = output_dir
+        self.outputs = outputs
         self.colours = texture_colours
+        self.block_size = block_size
+        self.padding = padding
+        self.cells = []
+        self.columns = 0
         self.image = []
         self.image_size = (0, 0)
         self.image_width = 0
         self.image_height = 0
         self.map = {}
-        self.generate_textures()
+        self.layout_texture()
+        if render: self.generate_textures()
         self.create_uv_map()
+
+    # Assign each opaque colour a cell and size the texture to fit them all
+    def layout_texture(self):
+        seen = set()
+        for c, rgba in self.colours.iteritems():
+            if rgba.a == 0 or c[:-1] in seen: continue
+            seen.add(c[:-1])
+            self.cells.append(c[:-1])
+        cell = self.block_size + self.padding * 2
+        size = 1
+        while (size // cell) ** 2 < max(len(self.cells), 1):
+            size *= 2
+        self.columns = size // cell
+        self.image_width = self.image_height = size
+        self.image_size = (size, size)
+
+    # Return the top-left pixel of the n-th cell
+    def get_cell_position(self, n):
+        cell = self.block_size + self.padding * 2
+        return (n % self.columns) * cell, (n // self.columns) * cell
         
-    # Create the UV map
+    # Create the UV map (the middle of each cell's block, to avoid bleeding)
+    # The inset is at least half a texel, so blocks under 4 pixels map to the middle of
+    # their texels rather than the edges shared with the next colour
     def create_uv_map(self):
-        x, y, x2, y2, w, h = 0, 0, 16, 16, float(self.image_width), float(self.image_height)
-        for c, rgba in self.colours.iteritems():
-            if rgba.a == 0: continue
-            self.map[c[:-1]] = {
-                'top-left' : UV(float(x+4) / w, float(y+4) / h),
-                'top-right' : UV(float(x2-4) / w, float(y+4) / h),
-                'bottom-left' : UV(float(x+4) / w, float(y2-4) / h),
-                'bottom-right' : UV(float(x2-4) / w, float(y2-4) / h),
+        w, h = float(self.image_width), float(self.image_height)
+        inset = max(self.block_size // 4, 0.5)
+        for n, c in enumerate(self.cells):
+            x, y = self.get_cell_position(n)
+            x, y = x + self.padding + inset, y + self.padding + inset
+            x2, y2 = x + self.block_size - inset * 2, y + self.block_size - inset * 2
+            self.map[c] = {
+                'top-left' : UV(float(x) / w, float(y) / h),
+                'top-right' : UV(float(x2) / w, float(y) / h),
+                'bottom-left' : UV(float(x) / w, float(y2) / h),
+                'bottom-right' : UV(float(x2) / w, float(y2) / h),
             }
-            x += 16
-            x2 += 16
     
-    # Generate textures (each 16x16 block is a unique colour from left->right)
+    # Generate textures (each row of cells is drawn as one pixel row repeated)
     def generate_textures(self):
-        for c, rgba in self.colours.iteritems():
-            if not rgba.a == 0:
-                self.draw_texture(16, 16, rgba)
+        cell = self.block_size + self.padding * 2
+        for i in xrange(0, len(self.cells), self.columns):
+            row = []
+            for rgb in self.cells[i:i + self.columns]:
+                row.extend(rgb * cell)
+            row.extend([0] * (self.image_width * 3 - len(row)))
+            self.image.extend([row] * cell)
+        blank = [0] * (self.image_width * 3)
+        self.image.extend([blank] * (self.image_height - len(self.image)))
         self.render_texture()
             
-    # Helper function to draw a single 16x16 block of the texture
-    def draw_texture(self, siz_x, siz_y, rgba):
-        for y in xrange(siz_y):
-            if y > len(self.image)-1:
-                self.image.append(list())
-            for x in xrange(siz_x):
-                self.image[y].append(rgba.r)
-                self.image[y].append(rgba.g)
-                self.image[y].append(rgba.b)
-        self.image_width = self.image_width + siz_x
-        self.image_height = siz_y
-            
-    # Write the texture to an image file (PNG format)
+    # Write the texture to an image file (PNG format), or a buffer in outputs
     def render_texture(self):
-        png.from_array(self.image, 'RGB').save(self.file_name)
+        texture = png.from_array(self.image, 'RGB')
+        if self.outputs is None:
+            texture.save(os.path.join(self.output_dir, self.file_name))
+        else: texture.write(output_file(self.file_name, outputs = self.outputs))
             
     # Return the entire UV map
     def get_uv_map(self):
@@ -419,63 +1852,924 @@ class ImageColoursUVMap(object):
     # Return the UV co-ordinate for the appropriate given colour
     def get_uv_coord(self, rgba):
         return self.map[(rgba.r, rgba.g, rgba.b)]
-        
+
+# ImageColoursUVMap shared by many models, kept in an atlas file (JSON) of its size
+# and colours (in cell order) with its texture in output_dir (tex_<atlas name>.png)
+# Colours keep their cells as the atlas is extended, so UVs never move and the
+# texture size is fixed when the atlas is created (atlas_size, or room for twice
+# the colours). Unless extend is set, the atlas is read only (and not rendered)
+# layout may be given as the atlas' contents (see get_layout) in place of the file,
+# and unless render is set the atlas is only laid out, writing nothing (for dry runs)
+class SharedColoursUVMap(ImageColoursUVMap):
+
+    # Constructor: Load the atlas, adding any new colours if extend is set
+    def __init__(self, atlas_file, texture_colours, output_dir = '', block_size = 16, padding = 0,
+            extend = False, atlas_size = None, layout = None, render = True):
+        self.atlas_file = atlas_file
+        self.extend = extend
+        self.atlas_size = atlas_size
+        self.layout = layout
+        self.render = render
+        self.changed = False
+        name = os.path.splitext(os.path.basename(atlas_file))[0]
+        ImageColoursUVMap.__init__(self, name + '.png', texture_colours, output_dir,
+            block_size, padding, render = render)
+
+    # Return the atlas file's contents, or None if there is no atlas yet
+    def read_atlas(self):
+        if not self.layout is None: return self.layout
+        if not os.path.isfile(self.atlas_file): return None
+        with open(self.atlas_file) as f:
+            return json.load(f)
+
+    # Keep the atlas' cells, adding new colours after them
+    def layout_texture(self):
+        atlas = self.read_atlas()
+        cell = self.block_size + self.padding * 2
+        if atlas:
+            if not (atlas['block_size'], atlas['padding']) == (self.block_size, self.padding):
+                raise ValueError('Atlas %s has a block size of %d and padding of %d' % (
+                    self.atlas_file, atlas['block_size'], atlas['padding']))
+            self.cells = [tuple(c) for c in atlas['colours']]
+        seen = set(self.cells)
+        for c, rgba in self.colours.iteritems():
+            if rgba.a == 0 or c[:-1] in seen: continue
+            if not self.extend:
+                raise ValueError('Colour %s is not in atlas %s' % (c[:-1], self.atlas_file))
+            seen.add(c[:-1])
+            self.cells.append(c[:-1])
+            self.changed = True
+        if atlas: size = atlas['size']
+        elif self.atlas_size: size = self.atlas_size
+        else:
+            size = 1
+            while (size // cell) ** 2 < max(len(self.cells) * 2, 1):
+                size *= 2
+        self.columns = size // cell
+        if len(self.cells) > self.columns ** 2:
+            raise ValueError('Atlas %s is full (%d colours), recreate it with a larger size' % (
+                self.atlas_file, self.columns ** 2))
+        self.image_width = self.image_height = size
+        self.image_size = (size, size)
+        if self.changed or not atlas:
+            self.changed = True
+            if not self.render: return
+            tmp = '%s.%d.tmp' % (self.atlas_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.get_layout(), f, indent = 1)
+            os.rename(tmp, self.atlas_file)
+
+    # Return the atlas' contents, as written to the atlas file
+    def get_layout(self):
+        return { 'version' : VERSION, 'texture' : self.file_name, 'size' : self.image_width,
+            'block_size' : self.block_size, 'padding' : self.padding,
+            'colours' : [list(c) for c in self.cells] }
+
+    # Render the texture when the atlas is created or extended (or it's missing)
+    def generate_textures(self):
+        if self.extend and (self.changed or
+                not os.path.isfile(os.path.join(self.output_dir, self.file_name))):
+            ImageColoursUVMap.generate_textures(self)
+
+# On-disk cache of conversion outputs, keyed on the decoded image and parameters
+# Entries are directories named by key; least recently used entries are evicted
+# once the cache grows beyond max_size bytes
+class ConversionCache(object):
+
+    # Constructor
+    def __init__(self, path, max_size = 512 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+
+    # Return the cache key for an image and the parameters it's converted with
+    # The rows are hashed as they are decoded again (see read_rows), so the image is
+    # never held in memory just to hash it
+    def key(self, img, params, rows = None):
+        if rows is None: rows = img.read_rows()
+        sha = hashlib.sha1()
+        sha.update(repr((VERSION, img.file_name, img.width, img.height, params)))
+        for row in rows:
+            sha.update(bytearray(row))
+        return sha.hexdigest()
+
+    # Copy cached outputs into output_dir, returns False if they aren't cached
+    def fetch(self, key, names, output_dir = ''):
+        entry = os.path.join(self.path, key)
+        if not all(os.path.isfile(os.path.join(entry, name)) for name in names):
+            return False
+        for name in names:
+            shutil.copyfile(os.path.join(entry, name), os.path.join(output_dir, name))
+        try: os.utime(entry, None)
+        except OSError: pass
+        return True
+
+    # Add outputs from output_dir to the cache, then evict old entries
+    def store(self, key, names, output_dir = ''):
+        entry = os.path.join(self.path, key)
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        if not os.path.isdir(tmp):
+            os.makedirs(tmp)
+        for name in names:
+            shutil.copyfile(os.path.join(output_dir, name), os.path.join(tmp, name))
+        try: os.rename(tmp, entry)
+        except OSError: shutil.rmtree(tmp, True)
+        self.evict()
+
+    # Remove least recently used entries until the cache fits in max_size
+    def evict(self):
+        entries, total = [], 0
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry): continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError: continue
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size: break
+            shutil.rmtree(entry, True)
+            total -= size
+
+# Default location of the conversion cache
+def default_cache_dir():
+    return os.environ.get('PNG2SMD_CACHE',
+        os.path.join(os.path.expanduser('~'), '.png2smd_cache'))
+
+# Return a shared atlas file's contents for a cache key's parameters (see
+# ConversionCache.key), '' if the atlas doesn't exist yet or None without an atlas
+def atlas_key(atlas):
+    if not atlas: return None
+    try:
+        with open(atlas) as f: return f.read()
+    except IOError: return ''
+
+# Return the peak memory use of this process in KB (ru_maxrss is bytes on Mac OS X)
+def peak_memory():
+    if resource is None: return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+# Return the (current, peak) resident memory of this process in KB, where the peak is
+# since the last reset_peak_memory(), or None where /proc isn't available (Linux only)
+def memory_usage():
+    try:
+        with open('/proc/self/status') as f: status = f.read()
+        return tuple(int(re.search(key + ':\\s*(\\d+)', status).group(1))
+            for key in ('VmRSS', 'VmHWM'))
+    except (IOError, AttributeError): return None
+
+# Reset the peak resident memory of this process, returning False if it can't be
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    except IOError: return False
+    return True
+
+# Stand-in for ConversionStats.stage when stats aren't being collected
+@contextlib.contextmanager
+def null_stage(name):
+    yield
+
+# Wall time and memory growth of each conversion stage, plus geometry counts
+class ConversionStats(object):
+
+    # Constructor
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.stages = []
+        self.counts = {}
+        self.peak = 0
+
+    # Time a stage of the conversion (used in a with statement), recording how far its
+    # memory use peaked above the memory in use when it started. Without /proc this is
+    # how far it raised the process's peak, so a stage under an earlier peak shows 0
+    @contextlib.contextmanager
+    def stage(self, name):
+        usage = memory_usage() if reset_peak_memory() else None
+        base = usage[0] if usage else peak_memory()
+        start = time.time()
+        try: yield
+        finally:
+            elapsed = time.time() - start
+            usage = usage and memory_usage()
+            peak = usage[1] if usage else peak_memory()
+            self.peak = max(self.peak, peak)
+            self.stages.append({ 'stage' : name, 'time' : elapsed,
+                'memory_increase_kb' : max(0, peak - base) })
+
+    # Return the stats as a dictionary (for JSON output)
+    def to_dict(self):
+        return { 'file' : self.input_file, 'stages' : self.stages, 'counts' : self.counts,
+            'time' : sum(stage['time'] for stage in self.stages),
+            'peak_memory_kb' : max(self.peak, peak_memory()) }
+
+# Print a progress message
+def log_stdout(msg):
+    print(msg)
+
+# Convert an image held in memory without touching the disk, where data is either
+# PNG file data or RGBA pixels (a flat sequence, rows or an HxWx4 array) of the
+# given width and height. Returns a dictionary of 'model', 'physics' (None without
+# collisions) and 'texture' file data, plus the 'names' each would be written as
+def convert_buffers(data, vdimensions, collisions = None, name = 'image.png', width = None,
+        height = None, engine = 'object', mesher = 'rows', block_size = 16, padding = 0,
+        output_format = 'smd', max_colours = None, alpha_threshold = None, max_hulls = None,
+        hull_tolerance = 0.0, merge_faces = False):
+    if width is None:
+        img = RgbaPngImage8(name, data)
+    else:
+        if hasattr(data, 'reshape'):
+            data = data.reshape(height, width * 4).tolist()
+        elif len(data) == width * height * 4:
+            data = [data[y*width*4:(y+1)*width*4] for y in xrange(height)]
+        if len(data) < height: raise Exception('Unexpected end-of-file')
+        img = RgbaImageRegion(list(data), name, 0, 0, width, height)
+        if engine == 'stream': engine = 'object'
+    if max_colours or not alpha_threshold is None:
+        img = QuantizedImage(img, max_colours, alpha_threshold)
+    image3d = Engines[engine](img)
+    image3d.optimize(mesher)
+    outputs = {}
+    imageuv = ImageColoursUVMap(image3d.original_file_name, image3d.get_colour_palette(),
+        '', block_size, padding, outputs)
+    name = model_name(image3d.original_file_name)
+    image3d.write(name, vdimensions, imageuv.file_name, imageuv.get_uv_map(), collisions, '',
+        outputs, output_format, max_hulls = max_hulls, hull_tolerance = hull_tolerance,
+        merge_faces = merge_faces)
+    names = { 'model' : model_file_name(name, '', output_format),
+        'physics' : model_file_name(name, '_phys', output_format), 'texture' : imageuv.file_name }
+    result = { 'names' : names }
+    for key, file_name in names.iteritems():
+        result[key] = outputs[file_name].getvalue() if file_name in outputs else None
+    return result
+
+# Return the ImageColoursUVMap for an image's colours, or its SharedColoursUVMap
+# (read only) if atlas (an atlas file) is given
+def create_uv_map(texture_name, texture_colours, output_dir = '', block_size = 16,
+        padding = 0, atlas = None, render = True, atlas_layout = None):
+    if atlas:
+        return SharedColoursUVMap(atlas, texture_colours, output_dir, block_size, padding,
+            layout = atlas_layout)
+    return ImageColoursUVMap(texture_name, texture_colours, output_dir, block_size, padding,
+        render = render)
+
+# Process pool worker: return (input_file, error or None, colour palette) of an image
+# file (see read_palette), quantized with options' max_colours and alpha_threshold
+def read_file_palette(job):
+    input_file, options = job
+    try:
+        img = RgbaPngImage8(input_file)
+        if options.get('max_colours') or not options.get('alpha_threshold') is None:
+            img = QuantizedImage(img, options.get('max_colours'), options.get('alpha_threshold'))
+        if getattr(img, 'palette', None) is not None:
+            return input_file, None, read_indexed_palette(img).keys()
+        return input_file, None, read_palette(img.image, img.width).keys()
+    except (png.Error, IOError, ValueError) as e:
+        return input_file, str(e) or e.__class__.__name__, None
+
+# Create or extend a shared atlas (see SharedColoursUVMap) with the colours of
+# input_files, read by a process pool of jobs workers. Returns the atlas' UV map
+# and the (input_file, error) of each file that couldn't be read, which are skipped
+# (a dry run only lays the atlas out, see SharedColoursUVMap.get_layout)
+def update_atlas(atlas, input_files, options, jobs = 1, atlas_size = None, dry_run = False):
+    work = [(input_file, options) for input_file in input_files]
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try: palettes = pool.map(read_file_palette, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else: palettes = map(read_file_palette, work)
+    colours, failures = {}, []
+    for input_file, error, palette in palettes:
+        if error:
+            failures.append((input_file, error))
+            continue
+        for rgba in palette:
+            if not rgba in colours: colours[rgba] = RGBA(*rgba)
+    return SharedColoursUVMap(atlas, colours, options.get('output_dir', ''),
+        options.get('block_size', 16), options.get('padding', 0), True, atlas_size,
+        render = not dry_run), failures
+
+# Quantize an image (see QuantizedImage), logging and counting (in stats) the error
+# If streaming is set, the image is quantized as it's read (see StreamingQuantizedImage)
+def quantize_image(img, max_colours, alpha_threshold = None, stats = None, log = None,
+        streaming = False):
+    if streaming: img = StreamingQuantizedImage(img, max_colours, alpha_threshold)
+    else: img = QuantizedImage(img, max_colours, alpha_threshold)
+    if log:
+        log('Reduced %d colours to %d (RMS error %.2f, max error %d)' % (img.colours,
+            img.palette_size, img.error, img.max_error))
+    if stats:
+        stats.counts.update({ 'quantize_colours' : img.colours,
+            'quantize_palette' : img.palette_size, 'quantize_rms_error' : img.error,
+            'quantize_max_error' : img.max_error })
+    return img
+
+# Convert a PNG file to an SMD model, its texture and (optionally) collision mesh
+# stats (a ConversionStats) collects stage timings and counts if given
+# jobs worker processes format the models of large images (see ParallelWritePixels)
+# A dry run writes nothing, returning the counts of PixelCubeImage.estimate and the
+# texture's size instead
+# (atlas_layout being the shared atlas as laid out by a dry run of update_atlas)
+# verify_incremental checks an incremental model against a full conversion
+def convert(input_file, vdimensions, collisions = None, engine = 'object',
+        mesher = 'rows', output_dir = '', block_size = 16, padding = 0, cache = None,
+        stats = None, log = None, output_format = 'smd', max_colours = None,
+        alpha_threshold = None, lods = 0, triangle_budget = None, atlas = None, jobs = 1,
+        max_hulls = None, hull_tolerance = 0.0, merge_faces = False, dry_run = False,
+        verify_incremental = False, atlas_layout = None):
+    log = log or (lambda msg: None)
+    stage = stats.stage if stats else null_stage
+    log('Reading input file...')
+    # PNG rows are decoded lazily, so 'open' only reads the header and the rows are
+    # decoded as they're read into the engine's image in 'decode' (or by 'quantize')
+    with stage('open'):
+        png_file = RgbaPngImage8(input_file)
+    if cache and not dry_run:
+        name = model_name(png_file.file_name)
+        names = [model_file_name(name, '', output_format)]
+        if not atlas: names.append('tex_' + png_file.file_name)
+        if not collisions == None: names.append(model_file_name(name, '_phys', output_format))
+        names.extend(model_file_name(name, '_lod%d' % level, output_format)
+            for level in xrange(1, lods + 1))
+        params = ((vdimensions.x, vdimensions.y, vdimensions.z), collisions, mesher,
+            block_size, padding, output_format, max_colours, alpha_threshold, lods,
+            triangle_budget, atlas_key(atlas), max_hulls, hull_tolerance,
+            merge_faces)
+        with stage('cache'):
+            key = cache.key(png_file, params)
+            cached = cache.fetch(key, names, output_dir)
+        if stats: stats.counts['cached'] = cached
+        if cached:
+            log('Using cached conversion...')
+            return
+    if max_colours or not alpha_threshold is None:
+        log('Quantizing colours...')
+        with stage('quantize'):
+            png_file = quantize_image(png_file, max_colours, alpha_threshold, stats, log,
+                engine == 'stream')
+    log('Converting between image formats...')
+    with stage('decode'):
+        image3d = Engines[engine](png_file)
+    if stats:
+        stats.counts['pixels'] = image3d.width * image3d.height
+        stats.counts['opaque_pixels'] = image3d.count_opaque()
+        stats.counts['palette'] = len(image3d.get_colour_palette())
+
+    ##
+    if DEBUG:
+        log('Testing image...')
+        image3d.test_render_image('test_image.png')
+    ##
+
+    log('Optimizing...')
+    image3d.optimize(mesher, stats)
+
+    ##
+    if DEBUG:
+        log('Testing optimizations...')
+        image3d.test_render_optimizer_visualization('test_image2.png')
+        log('Testing face visibility...')
+        image3d.test_render_face_visualization('test_image3.png')
+    ##
+
+    log('Generating textures and UV map...')
+    with stage('uvmap'):
+        imageuv = create_uv_map(image3d.original_file_name, image3d.get_colour_palette(),
+            output_dir, block_size, padding, atlas, not dry_run, atlas_layout)
+    if lods or not triangle_budget is None:
+        # the stream engine's levels are streamed too, so they keep its memory bound
+        levels = lod_images(png_file, vdimensions, engine == 'stream')
+        lod_engine = 'object' if engine == 'incremental' else engine
+    if not triangle_budget is None:
+        log('Finding the level of detail within %d triangles...' % triangle_budget)
+        with stage('budget'):
+            level, triangles = 0, image3d.count_triangles(merge_faces)
+            while triangles > triangle_budget and (image3d.width > 1 or image3d.height > 1):
+                level, img, vdimensions = next(levels)
+                image3d = Engines[lod_engine](img)
+                image3d.optimize(mesher)
+                triangles = image3d.count_triangles(merge_faces)
+            if triangles > triangle_budget:
+                log('Warning: No level of detail is within %d triangles' % triangle_budget)
+            log('Using level of detail %d (%d triangles)' % (level, triangles))
+        if stats: stats.counts['lod_level'] = level
+    if dry_run:
+        log('Measuring SMD model data...')
+        with stage('estimate'):
+            counts = image3d.estimate(vdimensions, imageuv.file_name, imageuv.get_uv_map(),
+                collisions, output_format, max_hulls, hull_tolerance, merge_faces)
+            counts['texture_width'], counts['texture_height'] = imageuv.image_size
+            for n in xrange(1, lods + 1):
+                level, img, lod_vdimensions = next(levels)
+                lod = Engines[lod_engine](img)
+                lod.optimize(mesher)
+                counts['lod%d_triangles' % n] = lod.count_triangles(merge_faces)
+        if stats: stats.counts.update(counts)
+        return counts
+    name = model_name(image3d.original_file_name)
+    log('Writing SMD model data...')
+    pool = None
+    if jobs > 1 and output_format == 'smd' and image3d.width * image3d.height >= ParallelWritePixels:
+        pool = multiprocessing.Pool(jobs)
+    try:
+        with stage('write'):
+            counts = image3d.write(name, vdimensions, imageuv.file_name,
+                imageuv.get_uv_map(), collisions, output_dir, output_format = output_format,
+                pool = pool, max_hulls = max_hulls, hull_tolerance = hull_tolerance,
+                merge_faces = merge_faces)
+            if verify_incremental and engine == 'incremental' and output_format == 'smd':
+                log('Verifying the model against a full conversion...')
+                image3d.verify(name, vdimensions, imageuv.file_name, imageuv.get_uv_map(),
+                    output_dir)
+            for n in xrange(1, lods + 1):
+                level, img, lod_vdimensions = next(levels)
+                lod = Engines[lod_engine](img)
+                lod.optimize(mesher)
+                lod_name = name.replace('.smd', '') + '_lod%d.smd' % n
+                lod_counts = lod.write(lod_name, lod_vdimensions, imageuv.file_name,
+                    imageuv.get_uv_map(), None, output_dir, output_format = output_format, pool = pool, merge_faces = merge_faces)
+                counts['lod%d_triangles' % n] = lod_counts['model_triangles']
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if stats: stats.counts.update(counts)
+    if cache:
+        cache.store(key, names, output_dir)
+
+# Run convert, returning its stats (as a dictionary) if collect_stats is set and
+# writing a cProfile dump to <profile_dir>/<name>.prof if profile_dir is given
+def convert_reported(input_file, options, collect_stats = False, profile_dir = None, log = None):
+    stats = ConversionStats(input_file) if collect_stats else None
+    if profile_dir:
+        profiler = cProfile.Profile()
+        try: profiler.runcall(convert, input_file, stats = stats, log = log, **options)
+        finally:
+            profiler.dump_stats(os.path.join(profile_dir,
+                os.path.basename(input_file).replace('.png', '') + '.prof'))
+    else: convert(input_file, stats = stats, log = log, **options)
+    return stats and stats.to_dict()
+
+# Process pool worker: convert one file, returning (input_file, error or None, stats)
+def convert_batch_file(job):
+    input_file, options, collect_stats, profile_dir = job
+    try:
+        stats = convert_reported(input_file, options, collect_stats, profile_dir)
+    except Exception as e:
+        return input_file, str(e) or e.__class__.__name__, None
+    return input_file, None, stats
+
+# Return the PNG files in a directory, or those matching a glob pattern
+def find_batch_files(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.png')
+    return sorted(glob.glob(path))
+
+# Convert many files over a process pool, returning the number of failures and
+# a list of each converted file's stats (if collect_stats is set). When collecting
+# stats each file is converted in a fresh process so its peak memory is its own
+def convert_batch(input_files, jobs, options, collect_stats = False, profile_dir = None):
+    work = [(input_file, options, collect_stats, profile_dir) for input_file in input_files]
+    if jobs > 1 or collect_stats:
+        pool = multiprocessing.Pool(jobs, maxtasksperchild = 1 if collect_stats else None)
+        try: results = pool.map(convert_batch_file, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else: results = map(convert_batch_file, work)
+    failed, stats = 0, []
+    for input_file, error, file_stats in results:
+        if error:
+            failed += 1
+            print('FAILED %s (%s)' % (input_file, error))
+        else: print('ok     %s' % input_file)
+        if file_stats: stats.append(file_stats)
+    print('Converted %d of %d files, %d failed' % (len(results) - failed, len(results), failed))
+    return failed, stats
+
+# Budgets a dry run checks: (command line option, counts key) of each
+DryRunBudgets = (('max-triangles', 'model_triangles'), ('max-bytes', 'model_bytes'),
+    ('max-texture', 'texture_width'))
+
+# Dry run input_files (see convert) in a process pool of jobs workers, printing each
+# model's counts and any budgets (a dictionary of limits by counts key) it exceeds.
+# Returns the number of files that failed or were over budget, and their stats
+# (each file is measured in a fresh process, as in convert_batch)
+def dry_run_batch(input_files, jobs, options, budgets, profile_dir = None):
+    options = dict(options, dry_run = True)
+    work = [(input_file, options, True, profile_dir) for input_file in input_files]
+    if len(work) > 1:
+        pool = multiprocessing.Pool(jobs, maxtasksperchild = 1)
+        try: results = pool.map(convert_batch_file, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else: results = map(convert_batch_file, work)
+    failed, stats = 0, []
+    for input_file, error, file_stats in results:
+        if error:
+            failed += 1
+            print('FAILED %s (%s)' % (input_file, error))
+            continue
+        stats.append(file_stats)
+        counts = file_stats['counts']
+        print('%s: %d triangles, %d vertices, %dx%d texture, %d bytes, %d collision boxes' % (
+            input_file, counts['model_triangles'], counts['model_vertices'],
+            counts['texture_width'], counts['texture_height'], counts['model_bytes'],
+            counts['physics_boxes']))
+        over = [(option, counts[key], budgets[key]) for option, key in DryRunBudgets
+            if key in budgets and counts[key] > budgets[key]]
+        for option, count, budget in over:
+            print('OVER   %s (%s %d, budget %d)' % (input_file, option, count, budget))
+        if over: failed += 1
+    print('Measured %d of %d files, %d failed or over budget' % (len(stats), len(results), failed))
+    return failed, stats
+
+# Write conversion stats to a JSON file
+def write_stats(file_name, stats):
+    with open(file_name, 'w') as f:
+        json.dump({ 'version' : VERSION, 'files' : stats }, f, indent = 4, sort_keys = True)
+
+# Decoded image rows shared with tile worker processes
+_tile_rows = None
+
+# Process pool initializer for tile workers
+def init_tile_worker(rows):
+    global _tile_rows
+    _tile_rows = rows
+
+# Run a region worker (ie. convert_tile) over work in a process pool of jobs
+# workers, sharing the decoded image rows with them
+def map_region_workers(worker, work, rows, jobs = 1):
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_tile_worker, (rows,))
+        try: return pool.map(worker, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    init_tile_worker(rows)
+    return map(worker, work)
+
+# Process pool worker: mesh and write one tile of _tile_rows
+def convert_tile(job):
+    (tx, ty, x, y, w, h), name, texture_file, uvmap, options = job
+    region = RgbaImageRegion(_tile_rows, name, x, y, w, h)
+    image3d = Engines[options['engine']](region)
+    image3d.set_border(region.get_border())
+    image3d.optimize(options['mesher'])
+    image3d.write('%s_%d_%d.smd' % (name, tx, ty), options['vdimensions'], texture_file,
+        uvmap, options['collisions'], options['output_dir'], output_format = options['output_format'],
+        max_hulls = options['max_hulls'], hull_tolerance = options['hull_tolerance'],
+        merge_faces = options['merge_faces'])
+
+# Return the cache key and output file names of a tile or frame conversion writing
+# models (named as passed to PixelCubeImage.write) and a manifest, hashing img's
+# decoded rows with params (see ConversionCache.key)
+def region_cache_entry(cache, img, rows, params, models, manifest, collisions = None,
+        output_format = 'smd', atlas = None):
+    names = [manifest] + [model_file_name(model, '', output_format) for model in models]
+    if not collisions == None:
+        names.extend(model_file_name(model, '_phys', output_format) for model in models)
+    if not atlas: names.append('tex_' + img.file_name)
+    return cache.key(img, params, rows), names
+
+# Convert a PNG file into tiles (mdl_<name>_<tx>_<ty>.smd) meshed in parallel,
+# sharing one texture, and write a manifest (mdl_<name>_tiles.json) of the tiles
+# Faces on tile edges are culled against neighbouring tiles and tiles without
+# any opaque pixels are skipped. The stream and incremental engines convert whole
+# images only, so can't be used
+def convert_tiled(input_file, tile_size, vdimensions, collisions = None, engine = 'object',
+        mesher = 'rows', output_dir = '', block_size = 16, padding = 0, jobs = 1, log = None,
+        output_format = 'smd', max_colours = None, alpha_threshold = None, atlas = None,
+        max_hulls = None, hull_tolerance = 0.0, merge_faces = False, cache = None):
+    log = log or (lambda msg: None)
+    if engine in ('stream', 'incremental'):
+        raise ValueError('The %s engine can not convert tiles' % engine)
+    log('Reading input file...')
+    png_file = RgbaPngImage8(input_file)
+    if max_colours or not alpha_threshold is None:
+        log('Quantizing colours...')
+        png_file = quantize_image(png_file, max_colours, alpha_threshold, log = log)
+    rows = list(png_file.image)
+    if len(rows) < png_file.height: raise Exception('Unexpected end-of-file')
+    width, height = png_file.width, png_file.height
+    name = png_file.file_name.replace('.png', '')
+    tiles = []
+    for ty, y in enumerate(xrange(0, height, tile_size[1])):
+        for tx, x in enumerate(xrange(0, width, tile_size[0])):
+            w, h = min(tile_size[0], width - x), min(tile_size[1], height - y)
+            if any(any(row[x*4+3:(x+w)*4:4]) for row in rows[y:y+h]):
+                tiles.append((tx, ty, x, y, w, h))
+    manifest_file = 'mdl_%s_tiles.json' % name
+    if cache:
+        params = ('tiles', tile_size, (vdimensions.x, vdimensions.y, vdimensions.z),
+            collisions, mesher, block_size, padding, output_format, max_colours,
+            alpha_threshold, atlas_key(atlas), max_hulls, hull_tolerance,
+            merge_faces)
+        key, names = region_cache_entry(cache, png_file, rows, params,
+            ['%s_%d_%d.smd' % (name, tx, ty) for tx, ty, x, y, w, h in tiles],
+            manifest_file, collisions, output_format, atlas)
+        if cache.fetch(key, names, output_dir):
+            log('Using cached conversion...')
+            return
+    log('Generating textures and UV map...')
+    imageuv = create_uv_map(png_file.file_name, read_palette(rows, width), output_dir,
+        block_size, padding, atlas)
+    options = { 'engine' : engine, 'mesher' : mesher, 'vdimensions' : vdimensions,
+        'collisions' : collisions, 'output_dir' : output_dir, 'output_format' : output_format,
+        'max_hulls' : max_hulls, 'hull_tolerance' : hull_tolerance, 'merge_faces' : merge_faces }
+    work = [(tile, name, imageuv.file_name, imageuv.get_uv_map(), options) for tile in tiles]
+    log('Writing SMD model data for %d tiles...' % len(tiles))
+    map_region_workers(convert_tile, work, rows, jobs)
+    manifest = { 'version' : VERSION, 'image' : png_file.file_name, 'size' : [width, height],
+        'tile_size' : list(tile_size), 'texture' : imageuv.file_name,
+        'dimensions' : [vdimensions.x, vdimensions.y, vdimensions.z], 'tiles' : [] }
+    for tx, ty, x, y, w, h in tiles:
+        tile = { 'tile' : [tx, ty], 'rect' : [x, y, w, h],
+            'model' : model_file_name('%s_%d_%d.smd' % (name, tx, ty), '', output_format),
+            # add to the tile model's vertices to place it in the whole image's model space
+            'offset' : [0.0, (x + w / 2.0 - width / 2.0) * vdimensions.x,
+                -(y + h / 2.0 - height / 2.0) * vdimensions.z] }
+        if not collisions == None:
+            tile['physics'] = model_file_name('%s_%d_%d.smd' % (name, tx, ty), '_phys',
+                output_format)
+        manifest['tiles'].append(tile)
+    with open(os.path.join(output_dir, manifest_file), 'w') as f:
+        json.dump(manifest, f, indent = 4, sort_keys = True)
+    if cache:
+        cache.store(key, names, output_dir)
+
+# Process pool worker: mesh and write one frame of _tile_rows
+def convert_frame(job):
+    n, (x, y, w, h), name, texture_file, uvmap, options = job
+    region = RgbaImageRegion(_tile_rows, name, x, y, w, h)
+    image3d = Engines[options['engine']](region)
+    image3d.optimize(options['mesher'])
+    image3d.write('%s_f%d.smd' % (name, n), options['vdimensions'], texture_file, uvmap,
+        options['collisions'], options['output_dir'], output_format = options['output_format'],
+        max_hulls = options['max_hulls'], hull_tolerance = options['hull_tolerance'],
+        merge_faces = options['merge_faces'])
+
+# Return the (x, y, width, height) frames of a sprite sheet split into a grid of
+# (columns, rows) frames, in row order
+def grid_frames(width, height, grid):
+    if width % grid[0] or height % grid[1]:
+        raise ValueError('%dx%d image can not be split into a %dx%d grid' % (width, height,
+            grid[0], grid[1]))
+    w, h = width // grid[0], height // grid[1]
+    return [(x * w, y * h, w, h) for y in xrange(grid[1]) for x in xrange(grid[0])]
+
+# Convert each frame of a sprite sheet to a model (mdl_<name>_f<n>.smd) meshed in
+# parallel, sharing one texture, and write a manifest (mdl_<name>_frames.json)
+# Frames are either a (columns, rows) grid or a list of (x, y, width, height)
+# rectangles. Each frame is centred on its own origin and empty frames are skipped
+# (as with tiles, the stream and incremental engines can't be used)
+def convert_sheet(input_file, frames, vdimensions, collisions = None, engine = 'object',
+        mesher = 'rows', output_dir = '', block_size = 16, padding = 0, jobs = 1, log = None,
+        output_format = 'smd', max_colours = None, alpha_threshold = None, atlas = None,
+        max_hulls = None, hull_tolerance = 0.0, merge_faces = False, cache = None):
+    log = log or (lambda msg: None)
+    if engine in ('stream', 'incremental'):
+        raise ValueError('The %s engine can not convert sprite sheet frames' % engine)
+    log('Reading input file...')
+    png_file = RgbaPngImage8(input_file)
+    if max_colours or not alpha_threshold is None:
+        log('Quantizing colours...')
+        png_file = quantize_image(png_file, max_colours, alpha_threshold, log = log)
+    rows = list(png_file.image)
+    if len(rows) < png_file.height: raise Exception('Unexpected end-of-file')
+    width, height = png_file.width, png_file.height
+    name = png_file.file_name.replace('.png', '')
+    if len(frames) == 2 and isinstance(frames[0], int):
+        frames = grid_frames(width, height, frames)
+    for x, y, w, h in frames:
+        if x < 0 or y < 0 or w < 1 or h < 1 or x + w > width or y + h > height:
+            raise ValueError('Frame %d,%d %dx%d is outside of the %dx%d image' % (x, y, w, h,
+                width, height))
+    drawn = [n for n, (x, y, w, h) in enumerate(frames)
+        if any(any(row[x*4+3:(x+w)*4:4]) for row in rows[y:y+h])]
+    manifest_file = 'mdl_%s_frames.json' % name
+    if cache:
+        params = ('frames', [tuple(frame) for frame in frames],
+            (vdimensions.x, vdimensions.y, vdimensions.z), collisions, mesher, block_size,
+            padding, output_format, max_colours, alpha_threshold, atlas_key(atlas),
+            max_hulls, hull_tolerance, merge_faces)
+        key, names = region_cache_entry(cache, png_file, rows, params,
+            ['%s_f%d.smd' % (name, n) for n in drawn], manifest_file, collisions,
+            output_format, atlas)
+        if cache.fetch(key, names, output_dir):
+            log('Using cached conversion...')
+            return
+    log('Generating textures and UV map...')
+    imageuv = create_uv_map(png_file.file_name, read_palette(rows, width), output_dir,
+        block_size, padding, atlas)
+    options = { 'engine' : engine, 'mesher' : mesher, 'vdimensions' : vdimensions,
+        'collisions' : collisions, 'output_dir' : output_dir, 'output_format' : output_format,
+        'max_hulls' : max_hulls, 'hull_tolerance' : hull_tolerance, 'merge_faces' : merge_faces }
+    work = [(n, frames[n], name, imageuv.file_name, imageuv.get_uv_map(), options) for n in drawn]
+    log('Writing SMD model data for %d frames...' % len(work))
+    map_region_workers(convert_frame, work, rows, jobs)
+    manifest = { 'version' : VERSION, 'image' : png_file.file_name, 'size' : [width, height],
+        'texture' : imageuv.file_name, 'dimensions' : [vdimensions.x, vdimensions.y, vdimensions.z],
+        'frames' : [] }
+    for n, (x, y, w, h) in enumerate(frames):
+        frame = { 'frame' : n, 'rect' : [x, y, w, h], 'model' : None }
+        if n in drawn:
+            frame['model'] = model_file_name('%s_f%d.smd' % (name, n), '', output_format)
+            if not collisions == None:
+                frame['physics'] = model_file_name('%s_f%d.smd' % (name, n), '_phys',
+                    output_format)
+        manifest['frames'].append(frame)
+    with open(os.path.join(output_dir, manifest_file), 'w') as f:
+        json.dump(manifest, f, indent = 4, sort_keys = True)
+    if cache:
+        cache.store(key, names, output_dir)
+
+# Print command line usage
+def usage():
+    print('Usage: png2smd.py <-f input_file | -d input_dir_or_glob> <-x width> <-y depth> <-z height> [-c scale]')
+    print('    [-o output_dir] [--jobs N] [--engine object|numpy|stream|incremental|sparse] [--mesher rows|greedy]')
+    print('    [--format smd|bin] [--max-colours N] [--alpha-threshold N] [--lods N] [--triangle-budget N]')
+    print('    [--max-hulls N] [--hull-tolerance F] [--merge-faces]')
+    print('    [--dry-run] [--max-triangles N] [--max-bytes N] [--max-texture N] [--verify-incremental]')
+    print('    [--no-cache] [--cache-dir dir] [--cache-size MB] [--tile WxH]')
+    print('    [--grid COLSxROWS] [--frames frames.json] [--atlas atlas.json] [--atlas-size N]')
+    print('    [--block-size N] [--padding N] [--stats file.json] [--profile dir]')
+    print('Note: <> are mandatory, where as [] are optional. See README for more details')
+
 def main(args):
     try:
-        opts, args = getopt.getopt(args[1:], 'f:x:y:z:c:')
+        opts, args = getopt.getopt(args[1:], 'f:d:o:x:y:z:c:', ['engine=', 'mesher=', 'jobs=',
+            'no-cache', 'cache-dir=', 'cache-size=', 'tile=',
+            'block-size=', 'padding=', 'stats=', 'profile=', 'format=', 'max-colours=',
+            'alpha-threshold=', 'lods=', 'triangle-budget=', 'grid=', 'frames=', 'atlas=',
+            'atlas-size=', 'max-hulls=', 'hull-tolerance=', 'merge-faces', 'dry-run',
+            'max-triangles=', 'max-bytes=', 'max-texture=', 'verify-incremental'])
     except getopt.GetoptError, err:
         print(str(err))
-        print('Usage: png2smd.py <-f input_file> <-x width> <-y depth> <-z height> [-c scale]')
-        print('Note: <> are mandatory, where as [] are optional. See README for more details')
+        usage()
         return -1
     input_file, width, depth, height, collisions = None, None, None, None, None
+    batch, output_dir, jobs = None, '', None
+    engine, mesher, output_format = 'object', 'rows', 'smd'
+    use_cache, cache_dir, cache_size = True, default_cache_dir(), 512
+    tile_size, block_size, padding = None, 16, 0
+    stats_file, profile_dir = None, None
+    max_colours, alpha_threshold = None, None
+    lods, triangle_budget = 0, None
+    frames, atlas, atlas_size = None, None, None
+    max_hulls, hull_tolerance, merge_faces = None, 0.0, False
+    dry_run, budgets = False, {}
+    verify_incremental = False
     
     try:
         for opt, val in opts:
             if opt == '-f' and len(val) > 0: input_file = str(val)
+            if opt == '-d' and len(val) > 0: batch = str(val)
+            if opt == '-o' and len(val) > 0: output_dir = str(val)
             if opt == '-x' and len(val) > 0: width = int(val)
             if opt == '-y' and len(val) > 0: depth = int(val)
             if opt == '-z' and len(val) > 0: height = int(val)
             if opt == '-c' and len(val) > 0: collisions = float(val)
-        if not input_file or not width or not depth or not height:
+            if opt == '--jobs': jobs = max(1, int(val))
+            if opt == '--no-cache': use_cache = False
+            if opt == '--cache-dir' and len(val) > 0: cache_dir = str(val)
+            if opt == '--cache-size':
+                cache_size = float(val)
+                if not 0 < cache_size < float('inf'): raise Exception()
+            if opt == '--stats' and len(val) > 0: stats_file = str(val)
+            if opt == '--profile' and len(val) > 0: profile_dir = str(val)
+            if opt == '--block-size': block_size = max(1, int(val))
+            if opt == '--padding': padding = max(0, int(val))
+            if opt == '--max-colours': max_colours = max(1, int(val))
+            if opt == '--lods': lods = max(0, int(val))
+            if opt == '--atlas' and len(val) > 0: atlas = str(val)
+            if opt == '--atlas-size': atlas_size = max(1, int(val))
+            if opt == '--triangle-budget': triangle_budget = max(0, int(val))
+            if opt == '--max-hulls': max_hulls = max(1, int(val))
+            if opt == '--merge-faces': merge_faces = True
+            if opt == '--dry-run': dry_run = True
+            if opt == '--verify-incremental': verify_incremental = True
+            for option, key in DryRunBudgets:
+                if opt == '--' + option: budgets[key] = max(0, int(val))
+            if opt == '--hull-tolerance':
+                hull_tolerance = float(val)
+                if not 0.0 <= hull_tolerance <= 1.0: raise Exception()
+            if opt == '--alpha-threshold':
+                alpha_threshold = int(val)
+                if not 0 <= alpha_threshold <= 255: raise Exception()
+            if opt == '--tile':
+                tile_size = tuple(int(v) for v in val.lower().split('x'))
+                if not len(tile_size) == 2 or min(tile_size) < 1: raise Exception()
+            if opt == '--grid':
+                if not frames is None: raise Exception()
+                frames = tuple(int(v) for v in val.lower().split('x'))
+                if not len(frames) == 2 or min(frames) < 1: raise Exception()
+            if opt == '--frames' and len(val) > 0:
+                if not frames is None: raise Exception()
+                with open(val) as f:
+                    frames = [tuple(int(v) for v in rect) for rect in json.load(f)]
+                if [rect for rect in frames if not len(rect) == 4]: raise Exception()
+            if opt == '--engine':
+                if not val in Engines: raise Exception()
+                engine = val
+            if opt == '--mesher':
+                if not val in Meshers: raise Exception()
+                mesher = val
+            if opt == '--format':
+                if not val in Extensions: raise Exception()
+                output_format = val
+        if not (input_file or batch) or not width or not depth or not height:
             raise Exception()
+        if verify_incremental and not engine == 'incremental': raise Exception()
+        if not mesher in Engines[engine].Meshers: raise Exception()
     except:
-        print('Usage: png2smd.py <-f input_file> <-x width> <-y depth> <-z height> [-c scale]')
-        print('Note: <> are mandatory, where as [] are optional. See README for more details')
+        usage()
+        return -1
+
+    options = { 'vdimensions' : Vector(width, depth, height), 'collisions' : collisions,
+        'engine' : engine, 'mesher' : mesher, 'output_dir' : output_dir,
+        'block_size' : block_size, 'padding' : padding, 'cache' : None,
+        'output_format' : output_format, 'max_colours' : max_colours,
+        'alpha_threshold' : alpha_threshold, 'lods' : lods, 'triangle_budget' : triangle_budget,
+        'atlas' : atlas, 'max_hulls' : max_hulls, 'hull_tolerance' : hull_tolerance,
+        'merge_faces' : merge_faces, 'verify_incremental' : verify_incremental }
+    if (tile_size or frames) and (stats_file or profile_dir):
+        print('Error: Tiles and frames can not collect stats or profiles')
+        return -1
+    if (tile_size or frames) and dry_run:
+        print('Error: Tiles and frames can not be dry run')
+        return -1
+    if tile_size and frames:
+        print('Error: An image can not be split into both tiles and frames')
+        return -1
+    if (tile_size or frames) and batch:
+        print('Error: Tiles and frames can not be converted in batch mode')
         return -1
+    # a dry run writes nothing, so it doesn't need the cache or output directory
+    if use_cache and not dry_run:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        options['cache'] = ConversionCache(cache_dir, int(cache_size * 1024 * 1024))
+    for path in (None if dry_run else output_dir, profile_dir):
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+    # a single model is only formatted in parallel if --jobs is given (batch mode,
+    # the atlas, tiles and frames use every CPU by default)
+    write_jobs, jobs = jobs or 1, jobs or multiprocessing.cpu_count()
+    input_files = find_batch_files(batch) if batch else [input_file]
+    if batch and not input_files:
+        print('Error: No PNG files found in %s' % batch)
+        return -1
+    # files the atlas couldn't read are reported and skipped, as batch failures are
+    unreadable = []
+    if atlas:
+        print('%s atlas %s...' % ('Laying out' if dry_run else 'Updating', atlas))
+        try:
+            uvmap, unreadable = update_atlas(atlas, input_files, options, jobs, atlas_size,
+                dry_run)
+        except (IOError, ValueError) as e:
+            print('Error: %s' % str(e))
+            return -1
+        for failed_file, error in unreadable:
+            print('FAILED %s (%s)' % (failed_file, error))
+            input_files.remove(failed_file)
+        print('Atlas %s has %d of %d colours' % (uvmap.file_name, len(uvmap.cells),
+            uvmap.columns ** 2))
+        if unreadable:
+            print('Skipping %d files the atlas could not read' % len(unreadable))
+        if not input_files: return -1
+        if dry_run: options['atlas_layout'] = uvmap.get_layout()
+    if dry_run:
+        failed, stats = dry_run_batch(input_files, jobs, options, budgets, profile_dir)
+        if stats_file: write_stats(stats_file, stats)
+        return -1 if failed or unreadable else 0
+    if batch:
+        failed, stats = convert_batch(input_files, jobs, options, bool(stats_file), profile_dir)
+        if stats_file: write_stats(stats_file, stats)
+        if failed or unreadable: return -1
+        print('Finished! Bye~')
+        return 0
     
     try:
         err = 0
-        print('Reading input file...')
-        png_file = RgbaPngImage8(input_file)
-        print('Converting between image formats...')
-        image3d = PixelCubeImage(png_file)
-        
-        ##
-        if DEBUG:
-            print('Testing image...')
-            image3d.test_render_image('test_image.png')
-        ##
-            
-        print('Optimizing...')
-        image3d.optimize()
-        
-        ##
-        if DEBUG:
-            print('Testing optimizations...')
-            image3d.test_render_optimizer_visualization('test_image2.png')
-            print('Testing face visibility...')
-            image3d.test_render_face_visualization('test_image3.png')
-        ##
-            
-        print('Generating textures and UV map...')
-        imageuv = ImageColoursUVMap(image3d.original_file_name,
-            image3d.get_colour_palette())
-        print('Writing SMD model data...')
-        image3d.write(image3d.original_file_name.replace('.png', '.smd'),
-            Vector(width, depth, height),
-            imageuv.file_name, imageuv.get_uv_map(), collisions)
-    except IOError as e:
+        if tile_size or frames:
+            if lods or not triangle_budget is None:
+                print('Error: Tiles and frames can not have levels of detail')
+                return -1
+            del options['lods'], options['triangle_budget'], options['verify_incremental']
+        if tile_size:
+            convert_tiled(input_file, tile_size, jobs = jobs, log = log_stdout, **options)
+        elif frames:
+            convert_sheet(input_file, frames, jobs = jobs, log = log_stdout, **options)
+        else:
+            stats = convert_reported(input_file, dict(options, jobs = write_jobs), bool(stats_file),
+                profile_dir, log_stdout)
+            if stats_file: write_stats(stats_file, [stats])
+    except (IOError, ValueError) as e:
         err += 1
         print('Error: %s' % str(e))
         
@@ -486,4 +2780,3 @@ def main(args):
 if __name__ == '__main__':
     sys.exit(main(sys.argv if (len(sys.argv) > 1) else
         'png2smd.py -f test.png -x 32 -y 16 -z 32 -c 1.0'.split()))
-
@@ -0,0 +1,383 @@
+# PNG2SMD Benchmark
+#
+# Times each stage of the png2smd pipeline on synthetic RGBA images
+# Using: Python-2.6+ (python.org), pypng (code.google.com/p/pypng)
+#
+# Usage: png2smd_bench.py [-o results.json] [-b baseline.json] [-t threshold]
+#                         [-r repeat] [--quick] [--engine] [--mesher] [--check]
+#
+#    -o specify file to write results to (ie. -o bench.json) - optional
+#    -b specify baseline results to compare against (ie. -b baseline.json) - optional
+#    -t specify slowdown ratio counted as a regression (ie. -t 1.25) - optional
+#    -r specify number of runs per case, the fastest is kept (ie. -r 3) - optional
+#    --quick only runs the small cases - optional
+#    --engine specify image engine, object, numpy, stream, incremental or sparse (ie. --engine numpy) - optional
+#    --mesher specify cube merging, rows or greedy (ie. --mesher greedy) - optional
+#    --check runs the output checks instead of the benchmarks - optional
+#
+# each case runs in a fresh process so peak memory (max RSS) is per case
+# exits with -1 if any stage is slower than the baseline by more than the threshold
+# a baseline recorded with a different engine, mesher or repeat is refused, and one
+# recorded by a different png2smd or Python version is compared with a warning
+# the checks compare faster paths' output byte for byte against the simple ones
+# (ie. draw_cubes against a draw_cube per cube), timing both, and exit with -1 on a mismatch
+# each engine, mesher and parallel write is checked by converting small synthetic images
+# (with levels of detail and a collision mesh) against the object engine's output
+#
+
+from __future__ import with_statement
+import os
+import sys
+import json
+import time
+import png
+import getopt
+import random
+import shutil
+import tempfile
+import multiprocessing
+from array import array
+import png2smd
+import psmdlib
+from png2smd import RgbaPngImage8, ImageColoursUVMap, Engines, peak_memory
+from psmdlib import Objects, Faces, UV, Vec3 as Vector
+
+# Stages timed for each case (in pipeline order)
+STAGES = ('load', 'construct', 'optimize_rows', 'optimize_columns', 'optimize_faces',
+    'uvmap', 'write')
+
+# Report settings a baseline must share to be compared against
+BASELINE_SETTINGS = ('engine', 'mesher', 'options')
+
+# Report settings only warned about when they differ from a baseline's
+BASELINE_ENVIRONMENT = ('version', 'python')
+
+# Synthetic image cases: (width, height, colours, transparency ratio, pattern)
+CASES = [(w, h, c, t, p) for w, h in ((32, 32), (128, 128), (512, 512))
+    for c in (4, 64) for t in (0.0, 0.5) for p in ('flat', 'noise')]
+QUICK_CASES = [case for case in CASES if case[0] <= 128]
+
+# Return a unique name for a benchmark case
+def case_name(case):
+    return '%dx%d_c%d_t%d_%s' % (case[0], case[1], case[2], int(case[3] * 100), case[4])
+
+# Generate a synthetic RGBA image (flat uses blocks of colour, noise random pixels)
+def generate_image(file_name, width, height, colours, transparency, pattern, seed = 1):
+    rnd = random.Random(seed)
+    palette = [(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255), 255)
+        for i in xrange(colours)]
+    block = max(1, min(width, height) // 8)
+    rows = []
+    for y in xrange(height):
+        row = []
+        for x in xrange(width):
+            if pattern == 'flat':
+                n = (x // block) * 31 + (y // block) * 17
+                rgba = palette[n % colours]
+                if (n * 7919 % 100) < transparency * 100: rgba = (0, 0, 0, 0)
+            else:
+                rgba = rnd.choice(palette)
+                if rnd.random() < transparency: rgba = (0, 0, 0, 0)
+            row.extend(rgba)
+        rows.append(row)
+    png.from_array(rows, 'RGBA').save(file_name)
+
+# Run the pipeline once on a case (in the current directory), returning its results
+def run_case(case, engine, mesher):
+    generate_image('bench.png', *case)
+    times = {}
+    def timed(stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        times[stage] = time.time() - start
+        return result
+    base_memory = peak_memory()
+    start = time.time()
+    img = RgbaPngImage8('bench.png')
+    img.image = list(img.image)
+    times['load'] = time.time() - start
+    image3d = timed('construct', Engines[engine], img)
+    if engine in ('stream', 'incremental'):
+        # streamed and incremental images are merged while writing
+        timed('optimize_rows', image3d.optimize, mesher)
+        times['optimize_columns'] = 0.0
+    elif mesher == 'greedy':
+        timed('optimize_rows', image3d.optimize_greedy)
+        times['optimize_columns'] = 0.0
+    else:
+        timed('optimize_rows', image3d.optimize_rows)
+        timed('optimize_columns', image3d.optimize_columns)
+    if not engine in ('stream', 'incremental'): timed('optimize_faces', image3d.optimize_faces)
+    else: times['optimize_faces'] = 0.0
+    uvmap = timed('uvmap', ImageColoursUVMap, 'bench.png', image3d.get_colour_palette())
+    timed('write', image3d.write, 'bench.smd', Vector(32, 16, 32), uvmap.file_name,
+        uvmap.get_uv_map())
+    with open('mdl_bench.smd') as f:
+        triangles = sum(1 for line in f if line.startswith(uvmap.file_name))
+    return { 'case' : case_name(case), 'times' : times,
+        'total' : sum(times.values()), 'triangles' : triangles,
+        'colours' : len(image3d.get_colour_palette()),
+        'peak_memory_kb' : peak_memory(), 'base_memory_kb' : base_memory }
+
+# Process pool worker: run a case in its own temporary directory
+def run_case_isolated(job):
+    case, engine, mesher = job
+    cwd, tmp = os.getcwd(), tempfile.mkdtemp(prefix = 'png2smd_bench')
+    try:
+        os.chdir(tmp)
+        return run_case(case, engine, mesher)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, True)
+
+# Run every case (each in a fresh process), keeping the fastest of repeat runs
+def run_benchmarks(cases, engine, mesher, repeat = 1):
+    results = []
+    for case in cases:
+        best = None
+        for i in xrange(repeat):
+            pool = multiprocessing.Pool(1)
+            try: result = pool.apply(run_case_isolated, ((case, engine, mesher),))
+            finally:
+                pool.close()
+                pool.join()
+            if best is None or result['total'] < best['total']: best = result
+        print('%-28s %8.3fs %9d tris %8d KB' % (best['case'], best['total'],
+            best['triangles'], best['peak_memory_kb']))
+        results.append(best)
+    return results
+
+# Return messages for the keys of a report whose values differ from a baseline's
+def compare_settings(report, baseline, keys):
+    return ['%s %s (baseline %s)' % (key, json.dumps(report[key], sort_keys = True),
+        json.dumps(baseline.get(key), sort_keys = True))
+        for key in keys if not baseline.get(key) == report[key]]
+
+# Compare results against a baseline, returning a list of regression messages
+def compare_results(results, baseline, threshold):
+    regressions = []
+    previous = dict((r['case'], r) for r in baseline['results'])
+    for result in results:
+        base = previous.get(result['case'])
+        if not base: continue
+        for stage in STAGES + ('total',):
+            now = result['total'] if stage == 'total' else result['times'][stage]
+            then = base['total'] if stage == 'total' else base['times'].get(stage, 0.0)
+            # ignore stages too quick to time reliably
+            if then < 0.01 and now < 0.01: continue
+            if now > then * threshold:
+                regressions.append('%s %s: %.3fs -> %.3fs (x%.2f)' % (result['case'],
+                    stage, then, now, now / max(then, 1e-9)))
+        if result['triangles'] > base['triangles']:
+            regressions.append('%s triangles: %d -> %d' % (result['case'],
+                base['triangles'], result['triangles']))
+    return regressions
+
+# Return the time taken by func and its result
+def time_call(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+# Return the SMD data of cubes drawn one at a time with draw_cube
+def draw_cube_loop(origins, sizes, materials, uvs, face_masks):
+    cc = Objects.Cube()
+    corners = ('top-left', 'top-right', 'bottom-left', 'bottom-right')
+    for c in xrange(len(origins) // 3):
+        i, k = c * 3, c * 8
+        face_uvs = dict(zip(corners, [UV(uvs[j], uvs[j+1]) for j in xrange(k, k + 8, 2)]))
+        cc.draw_cube(Vector(*origins[i:i+3]), Vector(*sizes[i:i+3]), materials[c],
+            dict((face, face_uvs) for face in Faces.Names), face_masks[c])
+    return cc.get_triangles()
+
+# Return the SMD data of cubes drawn with draw_cubes, with or without NumPy
+def draw_cubes_batch(origins, sizes, materials, uvs, face_masks, use_numpy = True):
+    saved = psmdlib.numpy
+    if not use_numpy: psmdlib.numpy = None
+    try:
+        cc = Objects.Cube()
+        cc.draw_cubes(origins, sizes, materials, uvs, face_masks)
+        return cc.get_triangles()
+    finally: psmdlib.numpy = saved
+
+# Return the number of triangles draw_cubes expands cubes to (without formatting them)
+def expand_cubes_only(origins, sizes, materials, uvs, face_masks, use_numpy = True):
+    expand = psmdlib._expand_cubes_numpy if use_numpy else psmdlib._expand_cubes_loop
+    return sum(len(buf) for buf in expand(origins, sizes, materials, uvs, face_masks, 256))
+
+# Check draw_cubes draws random cubes byte for byte as a draw_cube per cube does,
+# printing the times taken (drawing, and expanding the geometry without formatting
+# it). Returns a list of failure messages
+def check_draw_cubes(count = 20000, seed = 1):
+    rnd = random.Random(seed)
+    origins = array('d', [rnd.randint(-512, 512) * 0.5 for i in xrange(count * 3)])
+    sizes = array('d', [float(rnd.randint(1, 32)) for i in xrange(count * 3)])
+    uvs = array('d', [rnd.randint(0, 255) / 256.0 for i in xrange(count * 8)])
+    face_masks = array('i', [rnd.randint(0, 63) for i in xrange(count)])
+    materials = ['tex_%d.png' % rnd.randint(0, 3) for i in xrange(count)]
+    args = (origins, sizes, materials, uvs, face_masks)
+    failures = []
+    loop_time, expected = time_call(draw_cube_loop, *args)
+    print('%-28s %8.3fs' % ('draw_cube', loop_time))
+    paths = [('draw_cubes', False)]
+    if psmdlib.numpy is not None: paths.append(('draw_cubes (numpy)', True))
+    for name, use_numpy in paths:
+        elapsed, data = time_call(draw_cubes_batch, *(args + (use_numpy,)))
+        print('%-28s %8.3fs (x%.2f)' % (name, elapsed, loop_time / max(elapsed, 1e-9)))
+        if not data == expected: failures.append('%s differs from draw_cube' % name)
+    if psmdlib.numpy is not None:
+        loop_time, triangles = time_call(expand_cubes_only, *(args + (False,)))
+        elapsed, numpy_triangles = time_call(expand_cubes_only, *(args + (True,)))
+        print('%-28s %8.3fs -> %.3fs (x%.2f)' % ('expand cubes (numpy)', loop_time, elapsed,
+            loop_time / max(elapsed, 1e-9)))
+        if not triangles == numpy_triangles:
+            failures.append('expand cubes (numpy) differs in triangles')
+    return failures
+
+# Images converted by the conversion checks (see CASES)
+CHECK_CASES = [(48, 40, 6, 0.3, 'noise'), (64, 48, 4, 0.25, 'flat')]
+
+# Conversions checked against the object engine with the same mesher: (engine, mesher, jobs)
+CHECK_CONVERSIONS = [('numpy', 'rows', 1), ('stream', 'rows', 1), ('incremental', 'rows', 1),
+    ('sparse', 'rows', 1), ('object', 'rows', 2), ('numpy', 'greedy', 1),
+    ('sparse', 'greedy', 1), ('object', 'greedy', 2)]
+
+# Convert an image (in the current directory) into output_dir, returning the contents
+# of the files written (less the incremental engine's sidecar) by name. jobs > 1
+# writes the models with a process pool whatever the image's size
+def convert_outputs(file_name, output_dir, engine = 'object', mesher = 'rows', jobs = 1):
+    parallel_pixels = png2smd.ParallelWritePixels
+    png2smd.ParallelWritePixels = 0
+    try:
+        png2smd.convert(file_name, Vector(32, 16, 32), 1.0, engine, mesher, output_dir,
+            lods = 2, jobs = jobs)
+    finally: png2smd.ParallelWritePixels = parallel_pixels
+    outputs = {}
+    for name in os.listdir(output_dir):
+        if name.endswith('.inc'): continue
+        with open(os.path.join(output_dir, name), 'rb') as f:
+            outputs[name] = f.read()
+    return outputs
+
+# Return a failure message for each output differing from the expected outputs
+def compare_outputs(label, outputs, expected):
+    return ['%s %s differs from the object engine' % (label, name)
+        for name in sorted(set(outputs) | set(expected))
+        if not outputs.get(name) == expected.get(name)]
+
+# Check each of CHECK_CONVERSIONS converts CHECK_CASES byte for byte as the object
+# engine does, and that the incremental engine re-meshing an edited image does too
+# Returns a list of failure messages
+def check_conversions():
+    failures = []
+    cwd, tmp = os.getcwd(), tempfile.mkdtemp(prefix = 'png2smd_check')
+    try:
+        for n, case in enumerate(CHECK_CASES):
+            os.chdir(tmp)
+            os.mkdir(case_name(case))
+            os.chdir(case_name(case))
+            file_name = 'check.png'
+            generate_image(file_name, *case)
+            expected = {}
+            for engine, mesher, jobs in CHECK_CONVERSIONS:
+                if not mesher in expected:
+                    os.mkdir('object_%s' % mesher)
+                    expected[mesher] = convert_outputs(file_name, 'object_%s' % mesher,
+                        mesher = mesher)
+                label = '%s %s/%s%s' % (case_name(case), engine, mesher,
+                    ' (%d jobs)' % jobs if jobs > 1 else '')
+                output_dir = '%s_%s_%d' % (engine, mesher, jobs)
+                os.mkdir(output_dir)
+                found = compare_outputs(label, convert_outputs(file_name, output_dir, engine,
+                    mesher, jobs), expected[mesher])
+                print('%-8s %s' % ('FAILED' if found else 'ok', label))
+                failures.extend(found)
+            # recolour a pixel with another of the image's colours and re-mesh it
+            img = png.Reader(filename = file_name).asRGBA8()
+            rows = [list(row) for row in img[2]]
+            rows[case[1] // 2][case[0] // 2 * 4:case[0] // 2 * 4 + 4] = rows[0][0:4]
+            rows[0][0:4] = rows[-1][-4:]
+            png.from_array(rows, 'RGBA').save(file_name)
+            os.mkdir('edited')
+            label = '%s incremental/rows (edited)' % case_name(case)
+            found = compare_outputs(label, convert_outputs(file_name, 'incremental_rows_1',
+                'incremental'), convert_outputs(file_name, 'edited'))
+            print('%-8s %s' % ('FAILED' if found else 'ok', label))
+            failures.extend(found)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, True)
+    return failures
+
+# Run the output checks, returning a list of failure messages
+def run_checks():
+    failures = check_draw_cubes() + check_conversions()
+    for failure in failures:
+        print('FAILED %s' % failure)
+    return failures
+
+# Print command line usage
+def usage():
+    print('Usage: png2smd_bench.py [-o results.json] [-b baseline.json] [-t threshold] [-r repeat]')
+    print('    [--quick] [--engine object|numpy|stream|incremental|sparse] [--mesher rows|greedy]')
+    print('    [--check]')
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args[1:], 'o:b:t:r:', ['quick', 'engine=', 'mesher=',
+            'check'])
+    except getopt.GetoptError, err:
+        print(str(err))
+        usage()
+        return -1
+    output, baseline, threshold, repeat = None, None, 1.25, 1
+    cases, engine, mesher, check = CASES, 'object', 'rows', False
+    try:
+        for opt, val in opts:
+            if opt == '-o' and len(val) > 0: output = str(val)
+            if opt == '-b' and len(val) > 0: baseline = str(val)
+            if opt == '-t': threshold = float(val)
+            if opt == '-r': repeat = max(1, int(val))
+            if opt == '--quick': cases = QUICK_CASES
+            if opt == '--check': check = True
+            if opt == '--engine':
+                if not val in Engines: raise Exception()
+                engine = val
+            if opt == '--mesher':
+                if not val in png2smd.Meshers: raise Exception()
+                mesher = val
+        if not mesher in Engines[engine].Meshers: raise Exception()
+    except:
+        usage()
+        return -1
+
+    if check:
+        if run_checks(): return -1
+        print('All checks passed')
+        return 0
+    report = { 'version' : png2smd.VERSION, 'engine' : engine, 'mesher' : mesher,
+        'options' : { 'repeat' : repeat }, 'python' : sys.version.split()[0] }
+    if baseline:
+        with open(baseline) as f:
+            baseline_report = json.load(f)
+        mismatches = compare_settings(report, baseline_report, BASELINE_SETTINGS)
+        if mismatches:
+            print('Error: %s was recorded with different settings: %s' % (baseline,
+                ', '.join(mismatches)))
+            return -1
+        for mismatch in compare_settings(report, baseline_report, BASELINE_ENVIRONMENT):
+            print('Warning: %s was recorded with a different %s' % (baseline, mismatch))
+    report['results'] = results = run_benchmarks(cases, engine, mesher, repeat)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent = 4, sort_keys = True)
+    if baseline:
+        regressions = compare_results(results, baseline_report, threshold)
+        for regression in regressions:
+            print('Regression: %s' % regression)
+        if regressions: return -1
+        print('No regressions against %s' % baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,199 @@
+# PNG2SMD Server
+#
+# Serves png2smd conversions over localhost HTTP from a warm pool of worker processes
+# Using: Python-2.6+ (python.org), pypng (code.google.com/p/pypng)
+#
+# Usage: png2smd_server.py [-a] [-p] [--jobs] [--max-body]
+#
+#    -a specify address to listen on (ie. -a 127.0.0.1) - optional
+#    -p specify port to listen on (ie. -p 8093) - optional
+#    --jobs specify number of worker processes (ie. --jobs 4) - optional
+#    --max-body specify largest request body accepted in MB (ie. --max-body 64) - optional
+#
+# the server has no authentication, so listening on other than a loopback address
+# (anyone who can reach it may convert) prints a warning
+# requests with an invalid Content-Length get 400, and bodies over the limit 413
+# POST /convert?x=32&y=16&z=32[&c=1.0][&name=file.png][&engine=object][&mesher=rows]
+#     [&block_size=16][&padding=0][&format=smd][&max_colours=N][&alpha_threshold=N]
+#     [&max_hulls=N][&hull_tolerance=F][&merge_faces=1][&width=W&height=H]
+#   the request body is PNG file data, or raw RGBA pixels if width and height are given
+#   responds with JSON: names and base64 encoded model, physics (or null) and texture
+# GET /health responds with JSON: status, version and jobs
+#
+
+from __future__ import with_statement
+import sys
+import json
+import socket
+import base64
+import getopt
+import urlparse
+import traceback
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import png2smd
+from psmdlib import Vec3 as Vector
+
+# Parse a conversion request's query parameters, raising ValueError if invalid
+def parse_params(query):
+    values = dict((k, v[-1]) for k, v in urlparse.parse_qs(query).iteritems())
+    for key in ('x', 'y', 'z'):
+        if not key in values: raise ValueError('missing parameter: ' + key)
+    params = { 'vdimensions' : (float(values['x']), float(values['y']), float(values['z'])),
+        'collisions' : float(values['c']) if 'c' in values else None,
+        'name' : values.get('name', 'image.png'),
+        'engine' : values.get('engine', 'object'), 'mesher' : values.get('mesher', 'rows'),
+        'block_size' : int(values.get('block_size', 16)),
+        'padding' : int(values.get('padding', 0)),
+        'output_format' : values.get('format', 'smd'),
+        'max_colours' : int(values['max_colours']) if 'max_colours' in values else None,
+        'alpha_threshold' : int(values['alpha_threshold']) if 'alpha_threshold' in values else None,
+        'max_hulls' : int(values['max_hulls']) if 'max_hulls' in values else None,
+        'hull_tolerance' : float(values.get('hull_tolerance', 0.0)),
+        'merge_faces' : bool(int(values.get('merge_faces', 0))),
+        'width' : None, 'height' : None }
+    if 'width' in values or 'height' in values:
+        params['width'], params['height'] = int(values['width']), int(values['height'])
+        if params['width'] < 1 or params['height'] < 1: raise ValueError('invalid dimensions')
+    if not params['engine'] in png2smd.Engines: raise ValueError('unknown engine')
+    if not params['mesher'] in png2smd.Meshers: raise ValueError('unknown mesher')
+    if not params['mesher'] in png2smd.Engines[params['engine']].Meshers:
+        raise ValueError('the %s engine does not support the %s mesher' % (params['engine'],
+            params['mesher']))
+    if not params['output_format'] in png2smd.Extensions: raise ValueError('unknown format')
+    if not params['name'].endswith('.png') or '/' in params['name']:
+        raise ValueError('invalid name')
+    if params['block_size'] < 1 or params['padding'] < 0: raise ValueError('invalid texture layout')
+    if params['max_colours'] is not None and params['max_colours'] < 1:
+        raise ValueError('invalid max_colours')
+    if params['max_hulls'] is not None and params['max_hulls'] < 1:
+        raise ValueError('invalid max_hulls')
+    if not 0.0 <= params['hull_tolerance'] <= 1.0: raise ValueError('invalid hull_tolerance')
+    return params
+
+# Process pool worker: convert a request body, returning (error, result)
+def convert_job(job):
+    data, params = job
+    params = dict(params)
+    vdimensions = Vector(*params.pop('vdimensions'))
+    if params['width'] is not None:
+        data = bytearray(data)
+        if not len(data) == params['width'] * params['height'] * 4:
+            return 'expected %d bytes of RGBA pixels' % (params['width'] * params['height'] * 4), None
+    try:
+        result = png2smd.convert_buffers(data, vdimensions, **params)
+    except Exception as e:
+        return str(e) or e.__class__.__name__, None
+    for key in ('model', 'physics', 'texture'):
+        if result[key] is not None: result[key] = base64.b64encode(result[key])
+    return None, result
+
+# HTTP request handler, dispatching conversions to the server's pool
+class ConversionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Respond with a JSON document
+    def send_json(self, code, document):
+        body = json.dumps(document)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Health check
+    def do_GET(self):
+        if not urlparse.urlparse(self.path).path == '/health':
+            return self.send_json(404, { 'error' : 'not found' })
+        self.send_json(200, { 'status' : 'ok', 'version' : png2smd.VERSION,
+            'jobs' : self.server.jobs })
+
+    # Conversion
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if not url.path == '/convert':
+            return self.send_json(404, { 'error' : 'not found' })
+        try:
+            params = parse_params(url.query)
+            length = int(self.headers.getheader('Content-Length', 0))
+            if length < 0: raise ValueError('invalid Content-Length')
+        except (KeyError, ValueError) as e:
+            return self.send_json(400, { 'error' : str(e) })
+        if length > self.server.max_body:
+            return self.send_json(413, { 'error' : 'request body is over %d bytes' %
+                self.server.max_body })
+        data = self.rfile.read(length)
+        try:
+            error, result = self.server.pool.apply(convert_job, ((data, params),))
+        except Exception:
+            traceback.print_exc()
+            return self.send_json(500, { 'error' : 'conversion failed' })
+        if error: return self.send_json(400, { 'error' : error })
+        self.send_json(200, result)
+
+    # Quieter logging (only errors)
+    def log_request(self, code = '-', size = '-'):
+        if str(code)[0] != '2': BaseHTTPServer.BaseHTTPRequestHandler.log_request(self, code, size)
+
+# Threaded HTTP server owning a warm worker pool
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Constructor (max_body is the largest request body accepted, in bytes)
+    def __init__(self, address, jobs, max_body = 64 * 1024 * 1024):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ConversionHandler)
+        self.jobs = jobs
+        self.max_body = max_body
+        self.pool = multiprocessing.Pool(jobs)
+
+    # Stop the worker pool
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+# Return True if address (a host name or IP address) is a loopback address
+def is_loopback(address):
+    try: infos = socket.getaddrinfo(address, None)
+    except socket.error: return False
+    return all(info[4][0].startswith('127.') or info[4][0] == '::1' for info in infos)
+
+# Print command line usage
+def usage():
+    print('Usage: png2smd_server.py [-a address] [-p port] [--jobs N] [--max-body MB]')
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args[1:], 'a:p:', ['jobs=', 'max-body='])
+    except getopt.GetoptError, err:
+        print(str(err))
+        usage()
+        return -1
+    address, port, jobs = '127.0.0.1', 8093, multiprocessing.cpu_count()
+    max_body = 64.0
+    try:
+        for opt, val in opts:
+            if opt == '-a' and len(val) > 0: address = str(val)
+            if opt == '-p': port = int(val)
+            if opt == '--jobs': jobs = max(1, int(val))
+            if opt == '--max-body':
+                max_body = float(val)
+                if max_body <= 0: raise Exception()
+    except:
+        usage()
+        return -1
+
+    if not is_loopback(address):
+        print('Warning: Listening on %s, which is not a loopback address. The server has no '
+            'authentication, so anyone who can reach it may run conversions' % address)
+    server = ConversionServer((address, port), jobs, int(max_body * 1024 * 1024))
+    print('Serving png2smd %s on http://%s:%d/ with %d workers' % (png2smd.VERSION,
+        address, port, jobs))
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,13 +2,23 @@
 # Partial SMD Model Writer Lib
 #
 # Helps create valid .smd model files (static only)
-# Using: Python-2.5+ (python.org)
+# Also writes a binary indexed mesh format (see BinaryMeshStream)
+# Using: Python-2.5+ (python.org), NumPy (numpy.org, optional: speeds up draw_cubes)
 #
 
 from __future__ import with_statement
+import os
+import sys
+import struct
+import itertools
+from array import array
+from collections import deque
+try: import numpy
+except ImportError: numpy = None
 
 class Meta(object): pass
 class Objects(object): pass
+class Faces(object): pass
 
 # SMD string formatter for meta information sections
 Meta.Header = \
@@ -33,6 +43,56 @@ Meta.Triangle = \
 0    %s %s %s    %s %s %s    %s %s
 '''
 
+# Length of a formatted triangle less its material and values
+Meta.TriangleBytes = len(Meta.Triangle % (('',) * 25))
+
+# Face bitmask flags (a cube's excluded faces are OR'd together)
+Faces.Top = 0x01
+Faces.Bottom = 0x02
+Faces.Front = 0x04
+Faces.Right = 0x08
+Faces.Back = 0x10
+Faces.Left = 0x20
+Faces.Names = {
+    'top' : Faces.Top, 'bottom' : Faces.Bottom, 'front' : Faces.Front,
+    'right' : Faces.Right, 'back' : Faces.Back, 'left' : Faces.Left }
+
+# Convert a list of face names (ie. ['top', 'left']) to a face bitmask
+def faces_to_mask(faces):
+    if isinstance(faces, (int, long)): return faces
+    mask = 0
+    for face in faces:
+        mask |= Faces.Names[face]
+    return mask
+
+# Unit cube face table used by ObjectMaker_Cube.draw_cubes, in draw_cube's face order
+# Each face is (flag, normal, bl/br/tl/tr corners, reversed edge) where a corner
+# is (x << 2 | y << 1 | z) and 1 means origin + size along that axis
+Meta.CubeFaces = (
+    (Faces.Top, (0, 0, 1), (1, 3, 5, 7), False),
+    (Faces.Bottom, (0, 0, -1), (4, 6, 0, 2), False),
+    (Faces.Front, (-1, 0, 0), (0, 2, 1, 3), False),
+    (Faces.Right, (0, 1, 0), (2, 6, 3, 7), True),
+    (Faces.Back, (1, 0, 0), (6, 4, 7, 5), False),
+    (Faces.Left, (0, -1, 0), (4, 0, 5, 1), True),
+)
+
+# Expand the face table to six (corner, uv corner) vertices per face, matching
+# draw_face's triangle order (uv corners are top-left, top-right, bottom-left, bottom-right)
+def _expand_cube_faces():
+    faces = list()
+    for flag, normal, (bl, br, tl, tr), reversed_edge in Meta.CubeFaces:
+        if reversed_edge:
+            vertices = ((tr, 1), (br, 3), (bl, 2), (bl, 2), (tl, 0), (tr, 1))
+        else:
+            vertices = ((tl, 0), (tr, 1), (br, 3), (br, 3), (bl, 2), (tl, 0))
+        faces.append((flag, normal * 2, [v[0] for v in vertices], [v[1] for v in vertices]))
+    return tuple(faces)
+Meta.CubeFaceVertices = _expand_cube_faces()
+
+# Default UV co-ordinates for draw_cubes (top-left, top-right, bottom-left, bottom-right)
+Meta.CubeUVs = (0, 0, 1, 0, 0, 1, 1, 1)
+
 # 3D Vector (x, y, z)
 class Vec3(object):
 
@@ -56,47 +116,517 @@ class UV(object):
     def __init__(self, u, v):
         self.u, self.v = u, v
     
-# 3D SMD Model API  
+# Buffered SMD triangle output (triangles are written in chunks as they're drawn)
+# Given a pool (ie. a multiprocessing.Pool), GeometryBuffers are formatted in it
+# while drawing continues and written out in drawing order, so the output is
+# the same as formatting them in turn (at most pending_size chunks are in flight)
+# Batches of cubes (see write_cubes) are both expanded and formatted in the pool
+class SmdStream(object):
+    formatted = True
+
+    # Constructor: Write the SMD header to an open file
+    def __init__(self, f, chunk_size = 1024, pool = None, pending_size = 16):
+        self.file = f
+        self.chunk = list()
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self.pending = deque()
+        self.pending_size = pending_size
+        self.triangles = 0
+        self.bytes = len(Meta.Header)
+        self.file.write(Meta.Header)
+
+    # Queue a formatted triangle, writing out the chunk once it is full
+    def write(self, triangle):
+        self.chunk.append(triangle)
+        self.triangles += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    # Format and queue all triangles held in a GeometryBuffer
+    def write_buffer(self, buf):
+        if self.pool is None:
+            for triangle in buf.format_triangles():
+                self.write(triangle)
+            return
+        self.queue_chunk()
+        self.pending.append(self.pool.apply_async(format_geometry, (buf.get_parts(),)))
+        self.triangles += len(buf)
+        self.write_pending(self.pending_size)
+
+    # Queue a batch of cubes (draw_cubes' arguments) to be expanded and formatted in
+    # the pool (the triangles are counted as they're written out)
+    def write_cubes(self, cubes):
+        self.queue_chunk()
+        self.pending.append(self.pool.apply_async(format_cubes, (cubes,)))
+        self.write_pending(self.pending_size)
+
+    # Queue the current chunk behind any chunks still being formatted
+    def queue_chunk(self):
+        if self.chunk:
+            self.pending.append(''.join(self.chunk))
+            del self.chunk[:]
+
+    # Write out queued chunks (in order) until at most limit are left
+    def write_pending(self, limit = 0):
+        while len(self.pending) > limit:
+            data = self.pending.popleft()
+            if not isinstance(data, str): data = data.get()
+            if isinstance(data, tuple):
+                data, triangles = data
+                self.triangles += triangles
+            self.bytes += len(data)
+            self.file.write(data)
+
+    # Write out any queued triangles
+    def flush(self):
+        self.queue_chunk()
+        self.write_pending()
+
+    # Write the remaining triangles and the SMD footer
+    def close(self):
+        self.flush()
+        self.bytes += len(Meta.Footer)
+        self.file.write(Meta.Footer)
+
+# SMD triangle output that is only measured: counts the triangles and bytes an
+# SmdStream would write (header and footer included) without formatting them
+class SmdMeasure(object):
+    formatted = True
+
+    # Constructor
+    def __init__(self):
+        self.triangles = 0
+        self.bytes = len(Meta.Header) + len(Meta.Footer)
+        self.lengths = dict()
+
+    # Count a formatted triangle
+    def write(self, triangle):
+        self.triangles += 1
+        self.bytes += len(triangle)
+
+    # Count all triangles held in a GeometryBuffer
+    def write_buffer(self, buf):
+        self.triangles += len(buf)
+        self.bytes += buf.measure_triangles(self.lengths)
+
+    # Nothing is written
+    def close(self):
+        pass
+
+# Binary indexed mesh format (all values little-endian):
+#   header: magic 'PSMB', version (u16), index size in bytes (u16, 2 or 4),
+#     vertex count, index count, submesh count, vertex offset, index offset and
+#     submesh offset (u32 each), 32 bytes in total
+#   vertices: position x, y, z, normal x, y, z and uv u, v (f32 each, 32 bytes per vertex)
+#   indices: three per triangle (u16 if there are at most 65536 vertices, else u32)
+#   submeshes: first index, index count, name offset and name length (u32 each)
+#     per material, followed by the material names
+# Identical vertices (position, normal and uv) are welded and each material's
+# triangles are a contiguous range of indices (submeshes are in first drawn order)
+Meta.BinaryMagic = 'PSMB'
+Meta.BinaryVersion = 1
+Meta.BinaryHeader = struct.Struct('<4sHHIIIIII')
+Meta.BinarySubmesh = struct.Struct('<IIII')
+
+# Write an array's items little-endian to a file, returning the bytes written
+def _write_array(f, items):
+    if sys.byteorder == 'big':
+        items = array(items.typecode, items)
+        items.byteswap()
+    data = items.tostring()
+    f.write(data)
+    return len(data)
+
+# Buffered binary indexed mesh output (triangles are welded as they're drawn
+# and the whole mesh is written when closed)
+class BinaryMeshStream(object):
+    formatted = False
+
+    # Constructor
+    def __init__(self, f):
+        self.file = f
+        self.vertices = array('f')
+        self.vertex_ids = dict()
+        self.indices = dict()
+        self.materials = list()
+        self.triangles = 0
+        self.bytes = 0
+
+    # Return the indices of a material's triangles
+    def get_indices(self, mat):
+        indices = self.indices.get(mat)
+        if indices is None:
+            indices = self.indices[mat] = array('I')
+            self.materials.append(mat)
+        return indices
+
+    # Add a triangle from flat positions (9 values), normals (9) and uvs (6)
+    def add_triangle(self, mat, positions, normals, uvs):
+        indices, vertex_ids = self.get_indices(mat), self.vertex_ids
+        for v in xrange(3):
+            vertex = tuple(positions[v*3:v*3+3]) + tuple(normals[v*3:v*3+3]) + tuple(uvs[v*2:v*2+2])
+            i = vertex_ids.get(vertex)
+            if i is None:
+                i = vertex_ids[vertex] = len(vertex_ids)
+                self.vertices.extend(vertex)
+            indices.append(i)
+        self.triangles += 1
+
+    # Add all triangles held in a GeometryBuffer
+    def write_buffer(self, buf):
+        p, n, uv = buf.positions.tolist(), buf.normals.tolist(), buf.uvs.tolist()
+        vertex_ids, vertices = self.vertex_ids, self.vertices
+        for t, mat in enumerate(buf.materials):
+            indices = self.get_indices(mat)
+            normal = tuple(n[t*3:t*3+3])
+            for v in xrange(t * 3, t * 3 + 3):
+                vertex = tuple(p[v*3:v*3+3]) + normal + tuple(uv[v*2:v*2+2])
+                i = vertex_ids.get(vertex)
+                if i is None:
+                    i = vertex_ids[vertex] = len(vertex_ids)
+                    vertices.extend(vertex)
+                indices.append(i)
+        self.triangles += len(buf)
+
+    # Write the mesh (nothing is written until the stream is closed)
+    def flush(self):
+        pass
+
+    # Return the number of bytes close will write
+    def measure(self):
+        vertex_count = len(self.vertex_ids)
+        index_bytes = sum(len(indices) for indices in self.indices.itervalues()) * (
+            2 if vertex_count <= 0x10000 else 4)
+        return (Meta.BinaryHeader.size + vertex_count * 32 + index_bytes + -index_bytes % 4 +
+            len(self.materials) * Meta.BinarySubmesh.size + sum(len(m) for m in self.materials))
+
+    # Write the whole mesh to the file
+    def close(self):
+        vertex_count = len(self.vertex_ids)
+        indices = array('H' if vertex_count <= 0x10000 else 'I')
+        submeshes, names = list(), list()
+        names_offset = 0
+        for mat in self.materials:
+            submeshes.append((len(indices), len(self.indices[mat]), names_offset, len(mat)))
+            if indices.typecode == 'I': indices.extend(self.indices[mat])
+            else: indices.fromlist(self.indices[mat].tolist())
+            names.append(mat)
+            names_offset += len(mat)
+        vertex_offset = Meta.BinaryHeader.size
+        index_offset = vertex_offset + vertex_count * 32
+        index_bytes = len(indices) * indices.itemsize
+        padding = -index_bytes % 4
+        submesh_offset = index_offset + index_bytes + padding
+        names_offset = submesh_offset + len(submeshes) * Meta.BinarySubmesh.size
+        header = Meta.BinaryHeader.pack(Meta.BinaryMagic, Meta.BinaryVersion, indices.itemsize,
+            vertex_count, len(indices), len(submeshes), vertex_offset, index_offset, submesh_offset)
+        self.file.write(header)
+        self.bytes = len(header)
+        self.bytes += _write_array(self.file, self.vertices)
+        self.bytes += _write_array(self.file, indices)
+        self.file.write('\0' * padding)
+        for first, count, offset, length in submeshes:
+            self.file.write(Meta.BinarySubmesh.pack(first, count, names_offset + offset, length))
+        names = ''.join(names)
+        self.file.write(names)
+        self.bytes += padding + len(submeshes) * Meta.BinarySubmesh.size + len(names)
+
+# Read a binary indexed mesh from file data (a string, buffer or mmap), returning
+# its vertices (array of f32, 8 per vertex), indices (array) and submeshes as a
+# list of (material, first index, index count)
+def read_binary_mesh(data):
+    (magic, version, index_size, vertex_count, index_count, submesh_count,
+        vertex_offset, index_offset, submesh_offset) = Meta.BinaryHeader.unpack_from(data, 0)
+    if not magic == Meta.BinaryMagic or version > Meta.BinaryVersion:
+        raise ValueError('Not a binary mesh (or unsupported version)')
+    vertices, indices = array('f'), array('H' if index_size == 2 else 'I')
+    vertices.fromstring(data[vertex_offset:vertex_offset + vertex_count * 32])
+    indices.fromstring(data[index_offset:index_offset + index_count * index_size])
+    if sys.byteorder == 'big':
+        vertices.byteswap()
+        indices.byteswap()
+    submeshes = list()
+    for i in xrange(submesh_count):
+        first, count, offset, length = Meta.BinarySubmesh.unpack_from(data,
+            submesh_offset + i * Meta.BinarySubmesh.size)
+        submeshes.append((data[offset:offset + length], first, count))
+    return vertices, indices, submeshes
+
+# Flatten a draw_face UV dictionary to (u, v) pairs in draw_cubes' corner order
+def uv_corners(uvs):
+    return (uvs['top-left'].u, uvs['top-left'].v, uvs['top-right'].u, uvs['top-right'].v,
+        uvs['bottom-left'].u, uvs['bottom-left'].v, uvs['bottom-right'].u, uvs['bottom-right'].v)
+
+# Array-backed triangle geometry (positions, normals and UVs of each triangle)
+# UVs are stored as doubles, so int_uvs flags the triangles of cubes given integer
+# UVs (ie. draw_cubes' defaults) which are formatted as integers, as draw_cube does
+class GeometryBuffer(object):
+
+    # Constructor
+    def __init__(self):
+        self.positions = array('d')
+        self.normals = array('b')
+        self.uvs = array('d')
+        self.int_uvs = array('b')
+        self.materials = list()
+
+    # Return the number of triangles in the buffer
+    def __len__(self):
+        return len(self.materials)
+
+    # Empty the buffer
+    def clear(self):
+        del self.positions[:], self.normals[:], self.uvs[:], self.int_uvs[:], self.materials[:]
+
+    # Add the triangles of a cube's visible faces (corners are expanded from Meta.CubeFaces)
+    def add_cube(self, ox, oy, oz, sx, sy, sz, mat, uvs, ex_faces):
+        xs, ys, zs = (ox, ox + sx), (oy, oy + sy), (oz, oz + sz)
+        corners = [c for x in xs for y in ys for c in ((x, y, zs[0]), (x, y, zs[1]))]
+        int_uvs = not [v for v in uvs if not isinstance(v, (int, long))]
+        for flag, normals, vertices, uv_ids in Meta.CubeFaceVertices:
+            if ex_faces & flag: continue
+            for i in vertices:
+                self.positions.extend(corners[i])
+            self.normals.extend(normals)
+            for i in uv_ids:
+                self.uvs.extend(uvs[i * 2:i * 2 + 2])
+            self.int_uvs.extend((int_uvs, int_uvs))
+            self.materials.append(mat)
+            self.materials.append(mat)
+
+    # Return copies of the buffered positions, normals, UVs, integer UV flags and
+    # materials (see format_geometry)
+    def get_parts(self):
+        return (self.positions[:], self.normals[:], self.uvs[:], self.int_uvs[:],
+            self.materials[:])
+
+    # Return the buffered UVs as a list, those of int_uvs triangles being integers
+    def get_uvs(self):
+        uv = self.uvs.tolist()
+        if 1 in self.int_uvs:
+            for t, ints in enumerate(self.int_uvs):
+                if ints: uv[t*6:t*6+6] = [int(v) for v in uv[t*6:t*6+6]]
+        return uv
+
+    # Return the length of the buffered triangles in the SMD format without formatting
+    # them (lengths caches the formatted length of each position and UV value)
+    def measure_triangles(self, lengths):
+        total = Meta.TriangleBytes * len(self.materials) + sum(len(m) for m in self.materials)
+        for v in itertools.chain(self.positions, self.uvs):
+            # 0.0 and -0.0 are equal keys but formatted differently
+            n = lengths.get(v) if v else len(str(v))
+            if n is None: n = lengths[v] = len(str(v))
+            total += n
+        if 1 in self.int_uvs:
+            for t, ints in enumerate(self.int_uvs):
+                if not ints: continue
+                total += sum(len(str(int(v))) - len(str(v)) for v in self.uvs[t*6:t*6+6])
+        # each triangle's normal is repeated for its three vertices
+        return total + sum(len(str(n)) for n in self.normals) * 3
+
+    # Format the buffered triangles in the SMD format
+    def format_triangles(self):
+        p, n, uv = self.positions.tolist(), self.normals.tolist(), self.get_uvs()
+        fmt, triangles = Meta.Triangle, list()
+        for t, mat in enumerate(self.materials):
+            i, j, k = t * 9, t * 3, t * 6
+            triangles.append(fmt % (mat,
+                p[i], p[i+1], p[i+2], n[j], n[j+1], n[j+2], uv[k], uv[k+1],
+                p[i+3], p[i+4], p[i+5], n[j], n[j+1], n[j+2], uv[k+2], uv[k+3],
+                p[i+6], p[i+7], p[i+8], n[j], n[j+1], n[j+2], uv[k+4], uv[k+5]))
+        return triangles
+
+# Process pool worker: format the parts of a GeometryBuffer (see get_parts) as SMD data
+def format_geometry(parts):
+    buf = GeometryBuffer()
+    buf.positions, buf.normals, buf.uvs, buf.int_uvs, buf.materials = parts
+    return ''.join(buf.format_triangles())
+
+# Process pool worker: expand and format a batch of cubes (draw_cubes' arguments) as
+# SMD data, returning the data and its number of triangles
+def format_cubes(cubes):
+    data, triangles = list(), 0
+    for buf in expand_cubes(*cubes):
+        data.extend(buf.format_triangles())
+        triangles += len(buf)
+    return ''.join(data), triangles
+
+# Return whether each cube's uvs (see draw_cubes) are integers (ie. the defaults)
+def _int_uv_flags(uvs, count):
+    if uvs is None: return [True] * count
+    if isinstance(uvs, array): return [not uvs.typecode in 'fd'] * count
+    if numpy is not None and isinstance(uvs, numpy.ndarray):
+        return [uvs.dtype.kind in 'iub'] * count
+    return [not [v for v in uvs[c*8:c*8+8] if not isinstance(v, (int, long))]
+        for c in xrange(count)]
+
+# Yield GeometryBuffers of about batch_size cubes' triangles for draw_cubes'
+# arguments, expanding the cubes one at a time (used without NumPy)
+def _expand_cubes_loop(origins, sizes, materials, uvs, face_masks, batch_size):
+    buf = GeometryBuffer()
+    for c in xrange(len(origins) // 3):
+        i = c * 3
+        buf.add_cube(origins[i], origins[i+1], origins[i+2], sizes[i], sizes[i+1], sizes[i+2],
+            materials if isinstance(materials, str) else materials[c],
+            Meta.CubeUVs if uvs is None else uvs[c * 8:c * 8 + 8],
+            0 if face_masks is None else face_masks[c])
+        if len(buf) >= batch_size * 12:
+            yield buf
+            buf.clear()
+    yield buf
+
+# Yield GeometryBuffers of about batch_size cubes' triangles for draw_cubes'
+# arguments, expanding every cube at once: the cubes' corners are indexed with the
+# face table (Meta.CubeFaceVertices) and faces are dropped by masking with face_masks
+def _expand_cubes_numpy(origins, sizes, materials, uvs, face_masks, batch_size):
+    count = len(origins) // 3
+    o = numpy.array(origins, dtype = numpy.float64)[:count * 3].reshape(count, 3)
+    s = numpy.array(sizes, dtype = numpy.float64)[:count * 3].reshape(count, 3)
+    flags, normals, vertices, uv_ids = [numpy.array(column) for column in
+        zip(*Meta.CubeFaceVertices)]
+    # corner i of a cube is (x << 2 | y << 1 | z), 1 being origin + size (see Meta.CubeFaces)
+    ends = numpy.dstack((o, o + s))
+    bits = numpy.arange(8)
+    corners = numpy.dstack((ends[:, 0, bits >> 2], ends[:, 1, (bits >> 1) & 1],
+        ends[:, 2, bits & 1]))
+    masks = numpy.zeros(count, numpy.int64) if face_masks is None else numpy.array(
+        face_masks, dtype = numpy.int64)[:count]
+    visible = (masks[:, numpy.newaxis] & flags) == 0
+    positions = corners[:, vertices][visible].ravel()
+    normals = numpy.broadcast_to(normals.astype(numpy.int8), (count,) + normals.shape)[visible]
+    if uvs is None: uv = numpy.tile(numpy.array(Meta.CubeUVs, numpy.float64), count)
+    else: uv = numpy.array(uvs, dtype = numpy.float64)[:count * 8]
+    uv = uv.reshape(count, 4, 2)[:, uv_ids][visible].ravel()
+    int_uvs = numpy.repeat(numpy.array(_int_uv_flags(uvs, count), numpy.int8), 12).reshape(
+        count, 6, 2)[visible].ravel()
+    # each face is two triangles of its cube's material
+    faces = visible.sum(1) * 2
+    if isinstance(materials, str): mats = [materials] * int(faces.sum())
+    else: mats = numpy.repeat(numpy.array(list(materials[:count]), dtype = object), faces).tolist()
+    step = max(1, batch_size * 12)
+    for t in xrange(0, max(1, len(mats)), step):
+        buf = GeometryBuffer()
+        buf.positions.fromstring(positions[t*9:(t+step)*9].tostring())
+        buf.normals.fromstring(normals.ravel()[t*3:(t+step)*3].tostring())
+        buf.uvs.fromstring(uv[t*6:(t+step)*6].tostring())
+        buf.int_uvs.fromstring(int_uvs[t:t+step].tostring())
+        buf.materials = mats[t:t+step]
+        yield buf
+
+# Yield GeometryBuffers of the triangles of draw_cubes' arguments, in drawing order
+def expand_cubes(origins, sizes, materials, uvs = None, face_masks = None, batch_size = 256):
+    if numpy is None:
+        return _expand_cubes_loop(origins, sizes, materials, uvs, face_masks, batch_size)
+    return _expand_cubes_numpy(origins, sizes, materials, uvs, face_masks, batch_size)
+
+# 3D SMD Model API
+# When streaming, the file is opened straight away and triangles are written
+# as they are drawn (in drawing order) rather than being held until save
+# file_name may also be an open file-like object, which is left open on save
+# output_format is 'smd' or 'bin' (a binary indexed mesh, which is always streamed)
+# pool (ie. a multiprocessing.Pool) formats streamed SMD triangles in parallel chunks
 class Model(object):
+    Formats = ('smd', 'bin')
 
     # Constructor
-    def __init__(self, file_name):
+    def __init__(self, file_name, streaming = False, output_format = 'smd', pool = None):
+        if not output_format in Model.Formats: raise ValueError('Invalid output format')
         self.file = file_name
+        self.binary = output_format == 'bin'
         self.objects = list()
+        self.stream = None
+        self.triangles = 0
+        self.bytes = 0
+        self.opened = None
+        if self.binary:
+            self.stream = BinaryMeshStream(self.open_file())
+        elif streaming:
+            self.stream = SmdStream(self.open_file(), pool = pool)
+
+    # Use in a with statement to discard the model file if writing it fails
+    def __enter__(self):
+        return self
+
+    # Discard the model file on an exception (see discard)
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type: self.discard()
+
+    # Return the file to write to (opening it if given a file name)
+    def open_file(self):
+        if hasattr(self.file, 'write'): return self.file
+        self.opened = open(self.file, 'wb' if self.binary else 'w')
+        return self.opened
+
+    # Close and remove the model file if it was opened and not saved, so a failed
+    # model doesn't leave a partly written file behind
+    def discard(self):
+        if self.opened is None: return
+        self.opened.close()
+        self.opened = None
+        try: os.remove(self.file)
+        except OSError: pass
     
     # Adds an object to the model and returns its instance
     def create(self, obj):
         if issubclass(obj, ObjectMaker_TriangularFace):
-            self.objects.append(obj())
+            self.objects.append(obj(self.stream))
             return self.objects[-1]
         else: raise TypeError('Invalid object type')
         
-    # Saves the SMD file
+    # Saves the SMD file (and counts the triangles and bytes written)
     def save(self):
-        with open(self.file, 'w') as f:
+        if self.stream:
+            self.stream.close()
+            if not self.stream.file is self.file: self.stream.file.close()
+            self.opened = None
+            self.triangles, self.bytes = self.stream.triangles, self.stream.bytes
+            return
+        self.triangles, self.bytes = 0, len(Meta.Header) + len(Meta.Footer)
+        f = self.open_file()
+        try:
             f.write(Meta.Header)
             for obj in self.objects:
-                f.write(obj.get_triangles())
+                triangles = obj.get_triangles()
+                self.triangles += len(obj.triangles)
+                self.bytes += len(triangles)
+                f.write(triangles)
             f.write(Meta.Footer)
+        finally:
+            if not f is self.file: f.close()
+        self.opened = None
     
 # Base SMD triangle drawing code
 class ObjectMaker_TriangularFace(object):
 
     # Constructor
-    def __init__(self):
-        self.triangles = str()
+    def __init__(self, stream = None):
+        self.triangles = list()
+        self.stream = stream
     
     # Write a triangle in the SMD format
     def draw_triangle(self, mat, vp1, vp2, vp3, vn1, vn2, vn3, uv1, uv2, uv3):
-        self.triangles += Meta.Triangle % (
+        if self.stream and not self.stream.formatted:
+            self.stream.add_triangle(mat, (vp1.x, vp1.y, vp1.z, vp2.x, vp2.y, vp2.z, vp3.x, vp3.y, vp3.z),
+                (vn1.x, vn1.y, vn1.z, vn2.x, vn2.y, vn2.z, vn3.x, vn3.y, vn3.z),
+                (uv1.u, uv1.v, uv2.u, uv2.v, uv3.u, uv3.v))
+            return
+        triangle = Meta.Triangle % (
             mat,
             vp1.x, vp1.y, vp1.z, vn1.x, vn1.y, vn1.z, uv1.u, uv1.v,
             vp2.x, vp2.y, vp2.z, vn2.x, vn2.y, vn2.z, uv2.u, uv2.v,
             vp3.x, vp3.y, vp3.z, vn3.x, vn3.y, vn3.z, uv3.u, uv3.v)
+        if self.stream: self.stream.write(triangle)
+        else: self.triangles.append(triangle)
+
+    # Write all triangles held in a GeometryBuffer
+    def draw_buffer(self, buf):
+        if self.stream: self.stream.write_buffer(buf)
+        else: self.triangles.extend(buf.format_triangles())
             
-    # Return all triangle data (ie. model data)
+    # Return all triangle data (ie. model data), empty when streaming
     def get_triangles(self):
-        return self.triangles
+        return ''.join(self.triangles)
 
 # Model.create's public accessor wrapper for the ObjectMaker_TriangularFace class
 Objects.TriangularFace = ObjectMaker_TriangularFace
@@ -105,8 +635,8 @@ Objects.TriangularFace = ObjectMaker_TriangularFace
 class ObjectMaker_Cube(ObjectMaker_TriangularFace):
 
     # Constructor
-    def __init__(self):
-        self.triangles = str()
+    def __init__(self, stream = None):
+        ObjectMaker_TriangularFace.__init__(self, stream)
         
     # Draw the triangles necessary to create a square face
     def draw_face(self, vbl, vbr, vtl, vtr, vnorms, mat, uvs, reversed_edge = False):
@@ -134,50 +664,67 @@ class ObjectMaker_Cube(ObjectMaker_TriangularFace):
                 UV(0, 0) if not uvs else uvs['top-left'])
     
     # Draw the square faces necessary to create a cube
-    def draw_cube(self, v1, v2, mats, uvs = False, ex_faces = list()):
+    # ex_faces is a Faces bitmask (or a list of face names) of faces to skip
+    def draw_cube(self, v1, v2, mats, uvs = False, ex_faces = 0):
+        ex_faces = faces_to_mask(ex_faces)
         # top face
         bl = Vec3(v1.x, v1.y, v1.z + v2.z)  # bottom left vertex (top)
         br = Vec3(v1.x, v1.y + v2.y, v1.z + v2.z)  # bottom right vertex (top)
         tl = Vec3(v1.x + v2.x, v1.y, v1.z + v2.z)  # top left vertex (top)
         tr = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z + v2.z)  # top right vertex (top)
-        if not 'top' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Up,
+        if not ex_faces & Faces.Top: self.draw_face(bl, br, tl, tr, Vec3.Up,
             mats if isinstance(mats, str) else mats['top'], None if not uvs else uvs['top']) 
         # bottom face
         bl = Vec3(v1.x + v2.x, v1.y, v1.z)  # bottom left vertex (bottom)
         br = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z)  # bottom right vertex (bottom)
         tl = Vec3(v1.x, v1.y, v1.z)  # top left vertex (bottom)
         tr = Vec3(v1.x, v1.y + v2.y, v1.z)  # top right vertex (bottom)
-        if not 'bottom' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Down,
+        if not ex_faces & Faces.Bottom: self.draw_face(bl, br, tl, tr, Vec3.Down,
             mats if isinstance(mats, str) else mats['bottom'], None if not uvs else uvs['bottom'])
         # front face
         bl = Vec3(v1.x, v1.y, v1.z)  # bottom left vertex (front)
         br = Vec3(v1.x, v1.y + v2.y, v1.z)  # bottom right vertex (front)
         tl = Vec3(v1.x, v1.y, v1.z + v2.z)  # top left vertex (front)
         tr = Vec3(v1.x, v1.y + v2.y, v1.z + v2.z)  # top right vertex (front)
-        if not 'front' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Backward,
+        if not ex_faces & Faces.Front: self.draw_face(bl, br, tl, tr, Vec3.Backward,
             mats if isinstance(mats, str) else mats['front'], None if not uvs else uvs['front'])
         # right-side face
         bl = Vec3(v1.x, v1.y + v2.y, v1.z)  # bottom left vertex (right)
         br = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z)  # bottom right vertex (right)
         tl = Vec3(v1.x, v1.y + v2.y, v1.z + v2.z)  # top left vertex (right)
         tr = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z + v2.z)  # top right vertex (right)
-        if not 'right' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Right,
+        if not ex_faces & Faces.Right: self.draw_face(bl, br, tl, tr, Vec3.Right,
             mats if isinstance(mats, str) else mats['right'], None if not uvs else uvs['right'], True)
         # back face
         bl = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z)  # bottom left vertex (back)
         br = Vec3(v1.x + v2.x, v1.y, v1.z)  # bottom right vertex (back)
         tl = Vec3(v1.x + v2.x, v1.y + v2.y, v1.z + v2.z)  # top left vertex (back)
         tr = Vec3(v1.x + v2.x, v1.y, v1.z + v2.z)  # top right vertex (back)
-        if not 'back' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Forward,
+        if not ex_faces & Faces.Back: self.draw_face(bl, br, tl, tr, Vec3.Forward,
             mats if isinstance(mats, str) else mats['back'], None if not uvs else uvs['back'])
         # left-side face
         bl = Vec3(v1.x + v2.x, v1.y, v1.z)  # bottom left vertex (back)
         br = Vec3(v1.x, v1.y, v1.z)  # bottom right vertex (back)
         tl = Vec3(v1.x + v2.x, v1.y, v1.z + v2.z)  # top left vertex (back)
         tr = Vec3(v1.x, v1.y, v1.z + v2.z)  # top right vertex (back)
-        if not 'left' in ex_faces: self.draw_face(bl, br, tl, tr, Vec3.Left,
+        if not ex_faces & Faces.Left: self.draw_face(bl, br, tl, tr, Vec3.Left,
             mats if isinstance(mats, str) else mats['left'], None if not uvs else uvs['left'], True)
         
+    # Draw many cubes at once, taking flat sequences for the whole batch:
+    # origins/sizes hold x, y, z per cube, uvs hold 8 values per cube (see uv_corners)
+    # or None for default UVs, face_masks hold a Faces bitmask per cube and
+    # materials is either one material name or a sequence with one per cube
+    # The whole batch is expanded at once with NumPy if it's installed (see expand_cubes),
+    # or when streaming with a pool, expanded and formatted in it (see SmdStream.write_cubes)
+    def draw_cubes(self, origins, sizes, materials, uvs = None, face_masks = None, batch_size = 256):
+        if getattr(self.stream, 'pool', None) is not None:
+            # copied, as the pool pickles its arguments later and callers may reuse them
+            copy = lambda seq: seq if seq is None or isinstance(seq, str) else seq[:]
+            self.stream.write_cubes((copy(origins), copy(sizes), copy(materials), copy(uvs),
+                copy(face_masks), batch_size))
+            return
+        for buf in expand_cubes(origins, sizes, materials, uvs, face_masks, batch_size):
+            self.draw_buffer(buf)
+
 # Model.create's public accessor wrapper for the ObjectMaker_Cube class
 Objects.Cube = ObjectMaker_Cube
-